@@ -20,6 +20,8 @@ from config import config
 from utils.daemon import Daemon
 from ext.telegram.api import BotApi
 from bot.dealer import EvernoteDealerDaemon
+from bot.model import ensure_indexes
+from bot.storage import serve_shared_memory_storage
 
 
 def green(text):
@@ -37,12 +39,31 @@ def red(text):
 class BotDaemon(Daemon):
     def run(self):
         from web.webapp import app
+        ensure_indexes()
+        # run_app runs shutdown hooks (e.g. flush of user activity) when
+        # the loop stops, but it handles KeyboardInterrupt only
+        app.loop.add_signal_handler(signal.SIGTERM, self.on_sigterm, app.loop)
         aiohttp.web.run_app(app, port=config['port'])
 
+    @staticmethod
+    def on_sigterm(loop):
+        # stop() sends SIGTERM until the process exits, they must not
+        # interrupt shutdown
+        loop.add_signal_handler(signal.SIGTERM, lambda: None)
+        loop.stop()
+
+
+class StorageDaemon(Daemon):
+    def run(self):
+        serve_shared_memory_storage(config['storage'])
+
 
 class BotService:
     def __init__(self, config):
         self.config = config
+        self.storage_daemon = None
+        if config['storage']['class'] == 'bot.storage.SharedMemoryStorage':
+            self.storage_daemon = self.create_daemon('storage', StorageDaemon)
         self.dealer_daemon = self.create_daemon('dealer', EvernoteDealerDaemon)
         self.bot_daemon = self.create_daemon('bot', BotDaemon)
 
@@ -55,6 +76,8 @@ class BotService:
     def start(self):
         os.makedirs(self.config['logs_dir'], mode=0o700, exist_ok=True)
         os.makedirs(self.config['downloads_dir'], mode=0o700, exist_ok=True)
+        if self.storage_daemon:
+            self.storage_daemon.start()
         self.dealer_daemon.start()
         self.bot_daemon.start()
         print(green('OK\n'))
@@ -62,6 +85,8 @@ class BotService:
     def stop(self):
         self.dealer_daemon.stop()
         self.bot_daemon.stop()
+        if self.storage_daemon:
+            self.storage_daemon.stop()
         print(green('OK\n'))
 
     def restart(self):
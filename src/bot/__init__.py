@@ -1,12 +1,15 @@
-import datetime
 import importlib
 import json
 
 import asyncio
+import datetime
 import traceback
 
 from config import config
+from bot.activity import UserActivityBuffer
 from bot.model import User, FailedUpdate
+from bot.model import ModelNotFound
+from bot.model import UnitOfWork
 from bot.model import TelegramUpdate
 from bot.model import StartSession
 from bot.message_handlers import TextHandler
@@ -36,6 +39,7 @@ class EvernoteBot(TelegramBot):
     def __init__(self, token, name):
         super(EvernoteBot, self).__init__(token, name)
         self.evernote = Evernote(title_prefix='[TELEGRAM BOT]')
+        self.activity = UserActivityBuffer(**config.get('user_activity', {}))
         for cmd_class in get_commands():
             self.add_command(cmd_class)
         self.handlers = {
@@ -47,6 +51,14 @@ class EvernoteBot(TelegramBot):
             'location': LocationHandler(),
         }
 
+    async def handle_update(self, data: dict):
+        try:
+            async with UnitOfWork():
+                await super().handle_update(data)
+        except Exception as e:
+            message = "Can't save changes: {0}\nData: {1}\n\n".format(e, data)
+            self.logger.error(message, exc_info=1)
+
     async def set_current_notebook(self, user, notebook_name=None,
                                    notebook_guid=None):
         query = {}
@@ -81,7 +93,7 @@ class EvernoteBot(TelegramBot):
                 notebook['guid']
             )
             user.places[notebook['guid']] = note_guid
-            user.save()
+            await user.asave()
             note_link = await self.evernote.get_note_link(
                 user.evernote_access_token, note_guid
             )
@@ -106,7 +118,7 @@ notes will be saved in <a href="{0}">this note</a>'.format(note_link)
             await self.set_one_note_mode(user)
         else:
             user.mode = mode
-            user.save()
+            await user.asave()
             self.send_message(
                 chat_id,
                 'From now this bot in mode "{0}"'.format(text_mode),
@@ -129,7 +141,7 @@ notes will be saved in <a href="{0}">this note</a>'.format(note_link)
             user.current_notebook['guid']
         )
         user.places[user.current_notebook['guid']] = note_guid
-        user.save()
+        await user.asave()
         text = 'Bot switched to mode "One note"'
         asyncio.ensure_future(
             self.api.editMessageText(chat_id, reply['message_id'], text)
@@ -153,7 +165,13 @@ read and update your notes'
         inline_keyboard = {'inline_keyboard': [[signin_button]]}
         message_future = self.send_message(chat_id, text, inline_keyboard)
         config_data = config['evernote']['full_access']
-        session = StartSession.get({'id': user.id})
+        # /start session of registered user can be already removed by TTL
+        try:
+            session = await StartSession.aget({'id': user.id})
+        except ModelNotFound:
+            session = StartSession(id=user.id, key=StartSession.generate_key(),
+                                   data={'chat_id': chat_id}, oauth_data={})
+        session.created = datetime.datetime.utcnow()
         oauth_data = await self.evernote.get_oauth_data(user.id, config_data,
                                                         session.key)
         session.oauth_data = oauth_data
@@ -168,7 +186,7 @@ read and update your notes'
                 json.dumps(inline_keyboard)
             )
         )
-        session.save()
+        await session.asave()
 
     async def handle_request(self, user: User, request_type: str, message: Message):
         chat_id = user.telegram_chat_id
@@ -183,7 +201,7 @@ read and update your notes'
                 message=message
             )
         except TelegramBotError as e:
-            FailedUpdate.create(
+            await FailedUpdate.acreate(
                 user_id=user.id,
                 request_type=request_type,
                 status_message_id=status_message_id,
@@ -196,7 +214,7 @@ read and update your notes'
     async def handle_callback_query(self, query: CallbackQuery):
         data = json.loads(query.data)
         if data['cmd'] == 'set_nb':
-            user = User.get({'id': query.user.id})
+            user = await User.aget({'id': query.user.id})
             await self.set_current_notebook(user, notebook_guid=data['nb'])
 
     async def on_message_received(self, message: Message):
@@ -204,8 +222,8 @@ read and update your notes'
         if '/start' in message.bot_commands:
             return
 
-        if User.count({'id': user_id}) == 0:
-            if StartSession.count({'id': user_id}) > 0:
+        if await User.acount({'id': user_id}) == 0:
+            if await StartSession.acount({'id': user_id}) > 0:
                 message_text = 'Please, sign in to Evernote account first: /start'
                 error_text = 'User {0} not authorized in Evernote'.format(user_id)
             else:
@@ -214,7 +232,7 @@ read and update your notes'
             self.send_message(message.chat.id, message_text)
             raise TelegramBotError(error_text)
 
-        user = User.get({'id': user_id})
+        user = await User.aget({'id': user_id})
         if not hasattr(user, 'evernote_access_token') or \
            not user.evernote_access_token:
             self.send_message(
@@ -224,11 +242,10 @@ read and update your notes'
             raise TelegramBotError(
                 'User {0} not authorized in Evernote'.format(user.id)
             )
-        user.last_request_time = datetime.datetime.now()
-        user.save()
+        self.activity.touch(user.id)
 
     async def on_text(self, message: Message):
-        user = User.get({'id': message.user.id})
+        user = await User.aget({'id': message.user.id})
         text = message.text
         if user.state:
             if text.startswith('> ') and text.endswith(' <'):
@@ -238,26 +255,26 @@ read and update your notes'
             elif user.state == 'switch_mode':
                 await self.set_mode(user, text)
             user.state = None
-            user.save()
+            await user.asave()
         else:
             await self.handle_request(user, 'text', message)
 
     async def on_photo(self, message: Message):
-        user = User.get({'id': message.user.id})
+        user = await User.aget({'id': message.user.id})
         await self.handle_request(user, 'photo', message)
 
     async def on_video(self, message: Message):
-        user = User.get({'id': message.user.id})
+        user = await User.aget({'id': message.user.id})
         await self.handle_request(user, 'video', message)
 
     async def on_document(self, message: Message):
-        user = User.get({'id': message.user.id})
+        user = await User.aget({'id': message.user.id})
         await self.handle_request(user, 'document', message)
 
     async def on_voice(self, message: Message):
-        user = User.get({'id': message.user.id})
+        user = await User.aget({'id': message.user.id})
         await self.handle_request(user, 'voice', message)
 
     async def on_location(self, message: Message):
-        user = User.get({'id': message.user.id})
+        user = await User.aget({'id': message.user.id})
         await self.handle_request(user, 'location', message)
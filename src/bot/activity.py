@@ -0,0 +1,63 @@
+import asyncio
+import datetime
+
+from bot.model import User
+from utils.logs import get_logger
+
+
+class UserActivityBuffer:
+    '''
+    Write-behind buffer for User.last_request_time. Activity is coalesced
+    per user and written to storage in bulk every flush_interval seconds or
+    as soon as max_size users are pending. Call flush() on shutdown.
+    '''
+
+    def __init__(self, flush_interval=5, max_size=100, *, loop=None):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.logger = get_logger('bot')
+        self._loop = loop
+        self._pending = {}
+        self._timer = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def touch(self, user_id, timestamp=None):
+        self._merge({user_id: timestamp or datetime.datetime.now()})
+        if len(self._pending) >= self.max_size:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.flush_interval)
+
+    def _merge(self, activity: dict):
+        for user_id, timestamp in activity.items():
+            last_time = self._pending.get(user_id)
+            if last_time is None or last_time < timestamp:
+                self._pending[user_id] = timestamp
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        loop = self._loop or asyncio.get_event_loop()
+        self._timer = loop.call_later(
+            delay, lambda: asyncio.ensure_future(self.flush(), loop=loop)
+        )
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        updates = [
+            ({'id': user_id}, {'last_request_time': timestamp})
+            for user_id, timestamp in pending.items()
+        ]
+        try:
+            await User.abulk_update(updates)
+        except Exception:
+            self.logger.error("Can't save users activity", exc_info=1)
+            self._merge(pending)
+            self._schedule(self.flush_interval)
@@ -1,7 +1,5 @@
 import json
 import asyncio
-import random
-import string
 
 from config import config
 from bot.model import User
@@ -17,10 +15,7 @@ class StartCommand(TelegramBotCommand):
     async def execute(self, message: Message):
         chat_id = message.chat.id
         user_id = message.user.id
-        session_key = ''.join(
-            [random.choice(string.ascii_letters + string.digits)
-             for i in range(32)]
-        )
+        session_key = StartSession.generate_key()
         welcome_text = '''Welcome! It's bot for saving your notes to Evernote on fly.
 Please tap on button below to link your Evernote account with bot.'''
         signin_button = {
@@ -41,8 +36,8 @@ Please tap on button below to link your Evernote account with bot.'''
             },
             'chat_id': chat_id,
         }
-        StartSession.create(id=user_id, key=session_key, data=session_data,
-                            oauth_data=oauth_data)
+        await StartSession.acreate(id=user_id, key=session_key,
+                                   data=session_data, oauth_data=oauth_data)
         signin_button['text'] = 'Sign in to Evernote'
         signin_button['url'] = oauth_data['oauth_url']
         await asyncio.wait([welcome_message_future])
@@ -99,7 +94,7 @@ class SwitchNotebookCommand(TelegramBotCommand):
     name = 'notebook'
 
     async def execute(self, message: Message):
-        user = User.get({'id': message.user.id})
+        user = await User.aget({'id': message.user.id})
         notebooks = await self.bot.evernote.list_notebooks(
             user.evernote_access_token
         )
@@ -120,7 +115,7 @@ class SwitchNotebookCommand(TelegramBotCommand):
             }
         )
         user.state = 'select_notebook'
-        user.save()
+        await user.asave()
 
 
 class SwitchModeCommand(TelegramBotCommand):
@@ -128,7 +123,7 @@ class SwitchModeCommand(TelegramBotCommand):
     name = 'switch_mode'
 
     async def execute(self, message: Message):
-        user = User.get({'id': message.user.id})
+        user = await User.aget({'id': message.user.id})
         buttons = []
         for mode in ['one_note', 'multiple_notes']:
             if user.mode == mode:
@@ -146,4 +141,4 @@ class SwitchModeCommand(TelegramBotCommand):
             }
         )
         user.state = 'switch_mode'
-        user.save()
+        await user.asave()
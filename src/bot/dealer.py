@@ -1,6 +1,12 @@
 import asyncio
+import collections
+import datetime
+import os
+import socket
 import time
+import uuid
 
+from config import config
 from utils.logs import get_logger
 from bot.message_handlers import TextHandler
 from bot.message_handlers import PhotoHandler
@@ -8,8 +14,11 @@ from bot.message_handlers import VideoHandler
 from bot.message_handlers import DocumentHandler
 from bot.message_handlers import VoiceHandler
 from bot.message_handlers import LocationHandler
+from bot.model import FailedUpdate
 from bot.model import TelegramUpdate
 from bot.model import User
+from bot.model import ensure_indexes
+from bot.notify import get_notifier
 from utils.daemon import Daemon
 
 
@@ -19,9 +28,68 @@ class EvernoteDealer:
     appropriate handler(s)
     '''
 
+    # User fields required by message handlers
+    user_fields = [
+        'telegram_chat_id',
+        'mode',
+        'evernote_access_token',
+        'current_notebook',
+        'places',
+    ]
+
     def __init__(self, loop=None):
         self.__loop = loop or asyncio.get_event_loop()
         self.logger = get_logger('dealer')
+        dealer_config = config.get('dealer', {})
+        # storage is polled every poll_interval seconds while updates come,
+        # the interval doubles up to max_poll_interval while queue is empty.
+        # Notifier wakes dealer up at once when update is queued. Notifier
+        # may not reach dealer from web processes, then the interval is not
+        # increased by default
+        self.poll_interval = dealer_config.get('poll_interval', 0.1)
+        self.notifier = get_notifier()
+        if self.notifier.cross_process:
+            max_poll_interval = 1
+        else:
+            max_poll_interval = self.poll_interval
+        self.max_poll_interval = dealer_config.get('max_poll_interval',
+                                                   max_poll_interval)
+        # Every user with claimed updates has a lane (FIFO of update lists),
+        # lane is served by one of `workers` tasks at a time, so updates of
+        # one user are processed in order and different users in parallel.
+        # Lane is removed once it's empty. At most `queue_size` claimed
+        # updates wait in lanes, no more updates are claimed from storage
+        # until workers take them
+        self.workers = dealer_config.get('workers', 10)
+        self.queue_size = dealer_config.get('queue_size', 100)
+        # at most claim_size updates are claimed with one storage request
+        self.claim_size = dealer_config.get('claim_size', 100)
+        self.lanes = {}
+        # users loaded together with claimed updates for new lanes
+        self._lane_users = {}
+        # Claimed updates are leased to this dealer (worker_id) for
+        # lease_time seconds, leases are renewed every lease_time / 3 seconds
+        # while updates wait in lanes or are processed. Updates with expired
+        # leases (dealer crashed or was restarted) are claimed again by any
+        # dealer, update claimed more than max_attempts times is moved to
+        # FailedUpdate
+        self.worker_id = '{0}:{1}:{2}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lease_time = dealer_config.get('lease_time', 300)
+        self.max_attempts = dealer_config.get('max_attempts', 5)
+        self.leases = {}  # update id -> claimed update
+        self._next_reclaim = 0
+        # updates claimed by dealer of older version have no lease
+        self._legacy_reclaimed = False
+        # Failed update is retried in retry_delay * 2 ** (attempts - 1)
+        # seconds. Until then newer updates of the user are not processed
+        # by this dealer
+        self.retry_delay = dealer_config.get('retry_delay', 5)
+        self._delayed_users = {}  # user_id -> retry time
+        self.queue = asyncio.Queue()  # ids of users with idle lanes
+        self.pending = 0
+        self.in_flight = 0
+        self._queue_space = asyncio.Event()
         self.handlers = {
             'text': [TextHandler()],
             'photo': [PhotoHandler()],
@@ -36,33 +104,203 @@ class EvernoteDealer:
         self.__loop.run_until_complete(task)
         self.logger.fatal('Dealer down!')
 
+    def get_load(self) -> dict:
+        return {
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+            'queued': self.pending,
+            'lanes': len(self.lanes),
+            'leases': len(self.leases),
+        }
+
     async def async_run(self):
+        for _ in range(self.workers):
+            asyncio.ensure_future(self.worker())
+        asyncio.ensure_future(self.heartbeat())
+        interval = self.poll_interval
         while True:
+            free = self.queue_size - self.pending
+            if free <= 0:
+                # backpressure: leave updates in storage until a worker
+                # takes updates from a lane
+                self._queue_space.clear()
+                await self._queue_space.wait()
+                continue
             try:
-                updates_by_user = self.fetch_updates()
+                updates_by_user = await self.fetch_updates(limit=free)
             except Exception as e:
                 err = "{0}\nCan't load telegram updates from mongo".format(e)
                 self.logger.error(err, exc_info=1)
                 updates_by_user = None
             if not updates_by_user:
-                await asyncio.sleep(0.1)
+                if await self.notifier.wait(interval):
+                    interval = self.poll_interval
+                else:
+                    interval = min(interval * 2, self.max_poll_interval)
                 continue
+            interval = self.poll_interval
+            # users of busy lanes are reloaded by workers, they can be
+            # changed by updates being processed
+            users = await self.load_users(
+                [x for x in updates_by_user if x not in self.lanes])
             for user_id, updates in updates_by_user.items():
-                user = User.get({'id': user_id})
-                asyncio.ensure_future(self.process_user_updates(user, updates))
+                self.enqueue(user_id, updates, users.get(user_id))
 
-    def fetch_updates(self):
+    async def load_users(self, user_ids) -> dict:
+        '''
+        Loads users with one query. Returns dict user_id -> user
+        '''
+        if not user_ids:
+            return {}
+        try:
+            users = await User.afind({'id': {'$in': user_ids}},
+                                     fields=self.user_fields)
+        except Exception as e:
+            self.logger.error("Can't load users: {0}".format(e), exc_info=1)
+            return {}
+        return {user.id: user for user in users}
+
+    def enqueue(self, user_id, updates, user=None):
+        self.pending += len(updates)
+        lane = self.lanes.get(user_id)
+        if lane is not None:
+            # lane is waiting for a worker or being processed
+            lane.append(updates)
+            return
+        self.lanes[user_id] = collections.deque([updates])
+        if user is not None:
+            self._lane_users[user_id] = user
+        self.queue.put_nowait(user_id)
+
+    async def worker(self):
+        while True:
+            user_id = await self.queue.get()
+            lane = self.lanes[user_id]
+            self.in_flight += 1
+            try:
+                while lane:
+                    updates = []
+                    while lane:
+                        updates.extend(lane.popleft())
+                    self.pending -= len(updates)
+                    self._queue_space.set()
+                    user = self._lane_users.pop(user_id, None)
+                    unprocessed = await self.process_lane_updates(
+                        user_id, updates, user)
+                    if unprocessed:
+                        # newer updates of the user are returned to queue
+                        # too, so all of them are claimed again in order
+                        while lane:
+                            rest = lane.popleft()
+                            self.pending -= len(rest)
+                            unprocessed.extend(rest)
+                        self._queue_space.set()
+                        await self.retry_later(unprocessed)
+                    for update in updates:
+                        self.leases.pop(update.id, None)
+            finally:
+                # nothing was added to the lane since the last check
+                del self.lanes[user_id]
+                self.in_flight -= 1
+                self.queue.task_done()
+
+    async def process_lane_updates(self, user_id, updates, user=None):
+        '''
+        Returns updates which were not processed (the first one failed)
+        '''
+        processed = []
+        try:
+            if user is None:
+                user = await User.aget({'id': user_id},
+                                       fields=self.user_fields)
+            await self.process_user_updates(user, updates, processed)
+        except Exception as e:
+            self.logger.error(
+                "Can't process updates of user {0}: {1}".format(user_id, e),
+                exc_info=1)
+            return updates[len(processed):]
+        return []
+
+    async def retry_later(self, updates):
+        '''
+        Returns updates to queue with a delay growing with attempts. The
+        first update failed, the rest (newer ones) were not attempted
+        '''
+        failed = updates[0]
+        delay = self.retry_delay * 2 ** max(failed.attempts - 1, 0)
+        retry_time = datetime.datetime.now() + \
+            datetime.timedelta(seconds=delay)
+        self._delayed_users[failed.user_id] = retry_time
+        self._next_reclaim = min(self._next_reclaim,
+                                 time.monotonic() + delay)
+        await self.release(updates, retry_time, failed)
+
+    async def release(self, updates, retry_time, attempted=None):
+        '''
+        Sets leases of updates to expire at retry_time, then updates are
+        claimed again. Attempts of all updates except `attempted` one are
+        not counted
+        '''
+        requests = []
+        for update in updates:
+            values = {'worker_id': None, 'lease_expires': retry_time}
+            if update is not attempted:
+                values['attempts'] = update.attempts - 1
+            requests.append(
+                ({'id': update.id, 'worker_id': self.worker_id}, values))
+            self.leases.pop(update.id, None)
+        try:
+            await TelegramUpdate.abulk_update(requests)
+        except Exception as e:
+            # updates are claimed again when leases expire
+            self.logger.error("Can't release updates: {0}".format(e),
+                              exc_info=1)
+
+    async def fetch_updates(self, limit=None):
+        '''
+        Claims at most `limit` (and at most claim_size) oldest queued updates
+        with one storage request. Returns dict user_id -> list of updates
+        '''
         self.logger.debug('Fetching telegram updates...')
         updates_by_user = {}
-        fetched_updates = []
-        query = {'in_process': {'$exists': False}}
-        update_query = {'$set': {'in_process': True}}
+        limit = min(limit or self.claim_size, self.claim_size)
+        now = datetime.datetime.now()
+        lease = {
+            'in_process': True,
+            'worker_id': self.worker_id,
+            'lease_expires': now + datetime.timedelta(seconds=self.lease_time),
+        }
         sort = [('created', 1)]
-        while True:
-            update = TelegramUpdate.find_and_modify(query, update_query, sort)
-            if not update:
-                break
-            fetched_updates.append(update)
+        fetched_updates = []
+        if time.monotonic() >= self._next_reclaim:
+            self._next_reclaim = time.monotonic() + self.lease_time / 3
+            query = {'in_process': True, 'lease_expires': {'$lt': now}}
+            fetched_updates = await TelegramUpdate.aclaim(
+                query, lease, sort, limit, increment={'attempts': 1})
+            if not self._legacy_reclaimed and len(fetched_updates) < limit:
+                query = {'in_process': True,
+                         'lease_expires': {'$exists': False}}
+                legacy_updates = await TelegramUpdate.aclaim(
+                    query, lease, sort, limit - len(fetched_updates),
+                    increment={'attempts': 1})
+                self._legacy_reclaimed = \
+                    len(fetched_updates) + len(legacy_updates) < limit
+                fetched_updates += legacy_updates
+            if fetched_updates:
+                self.logger.warning('Reclaimed {0} updates with expired '
+                                    'leases'.format(len(fetched_updates)))
+                fetched_updates = await self.drop_failed(fetched_updates)
+        if len(fetched_updates) < limit:
+            query = {'in_process': {'$exists': False}}
+            fetched_updates += await TelegramUpdate.aclaim(
+                query, lease, sort, limit - len(fetched_updates),
+                increment={'attempts': 1})
+        # reclaimed updates are older than new ones, but come from several
+        # requests
+        fetched_updates.sort(key=lambda x: x.created)
+        for update in fetched_updates:
+            self.leases[update.id] = update
+        fetched_updates = await self.delay_updates(fetched_updates, now)
         self.logger.debug('Fetched {} updates'.format(len(fetched_updates)))
         for update in fetched_updates:
             user_id = update.user_id
@@ -71,31 +309,104 @@ class EvernoteDealer:
             updates_by_user[user_id].append(update)
         return updates_by_user
 
-    async def process_user_updates(self, user, update_list):
+    async def delay_updates(self, updates, now):
+        '''
+        Releases updates of users whose failed updates wait for retry, so
+        they are processed after failed ones. Returns the rest of updates
+        '''
+        self._delayed_users = {
+            user_id: retry_time
+            for user_id, retry_time in self._delayed_users.items()
+            if retry_time > now
+        }
+        delayed = {}
+        for update in updates:
+            if update.user_id in self._delayed_users:
+                delayed.setdefault(update.user_id, []).append(update)
+        for user_id, user_updates in delayed.items():
+            await self.release(user_updates, self._delayed_users[user_id])
+        return [x for x in updates if x.user_id not in delayed]
+
+    async def process_user_updates(self, user, update_list, processed=None):
+        '''
+        Processed updates are appended to `processed` list
+        '''
         start_ts = time.time()
         self.logger.debug(
             'Start update list processing (user_id = {0})'.format(user.id)
         )
-        for update in update_list:
-            for handler in self.handlers[update.request_type]:
-                await handler.execute(
-                    user,
-                    status_message_id=update.status_message_id,
-                    request_type=update.request_type,
-                    message=update.message)
-        self.logger.debug('Cleaning up...')
-        for update in update_list:
-            for handler in self.handlers[update.request_type]:
-                await handler.cleanup(user, update)
+        if processed is None:
+            processed = []
+        try:
+            for update in update_list:
+                for handler in self.handlers[update.request_type]:
+                    await handler.execute(
+                        user,
+                        status_message_id=update.status_message_id,
+                        request_type=update.request_type,
+                        message=update.message)
+                processed.append(update)
+        finally:
+            # processed updates are not retried if the next one fails
+            self.logger.debug('Cleaning up...')
+            for update in processed:
+                for handler in self.handlers[update.request_type]:
+                    await handler.cleanup(user, update)
+            await TelegramUpdate.abulk_delete(processed)
 
         log_message = 'Done. (user_id = {0}). Processing takes {1} s'.format(
             user.id, time.time() - start_ts
         )
         self.logger.debug(log_message)
 
+    async def drop_failed(self, updates):
+        '''
+        Moves updates claimed more than max_attempts times to FailedUpdate.
+        Returns the rest of updates
+        '''
+        failed = [x for x in updates if x.attempts > self.max_attempts]
+        for update in failed:
+            await FailedUpdate.acreate(
+                user_id=update.user_id,
+                request_type=update.request_type,
+                status_message_id=update.status_message_id,
+                message=update.message,
+                error='Not processed in {0} attempts'.format(
+                    self.max_attempts))
+        await TelegramUpdate.abulk_delete(failed)
+        return [x for x in updates if x.attempts <= self.max_attempts]
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease_time / 3)
+            try:
+                await self.renew_leases()
+            except Exception as e:
+                self.logger.error("Can't renew leases: {0}".format(e),
+                                  exc_info=1)
+
+    async def renew_leases(self):
+        '''
+        Extends leases of updates which wait in lanes or are processed
+        '''
+        if not self.leases:
+            return
+        lease_expires = datetime.datetime.now() + \
+            datetime.timedelta(seconds=self.lease_time)
+        updates = [
+            ({'id': update_id, 'worker_id': self.worker_id},
+             {'lease_expires': lease_expires})
+            for update_id in self.leases
+        ]
+        renewed = await TelegramUpdate.abulk_update(updates)
+        if renewed < len(updates):
+            self.logger.warning('{0} of {1} leases were lost'.format(
+                len(updates) - renewed, len(updates)))
+
 
 class EvernoteDealerDaemon(Daemon):
 
     def run(self):
+        ensure_indexes()
         dealer = EvernoteDealer()
         dealer.run()
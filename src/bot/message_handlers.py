@@ -76,7 +76,7 @@ class BaseHandler:
         else:
             self.logger.warn('User {0} has invalid mode {1}'.format(user.id, user.mode))
             user.mode = 'multiple_notes'
-            user.save()
+            await user.asave()
             await self._create_note(user, request_type, message)
 
     async def _create_note(self, user: User, request_type: str, message: Message):
@@ -112,7 +112,11 @@ class BaseHandler:
         )
 
     async def cleanup(self, user: User, update: TelegramUpdate):
-        update.delete()
+        '''
+        Removes temporary data of processed update. Updates are deleted from
+        queue by dealer
+        '''
+        pass
 
 
 class FileHandler(BaseHandler):
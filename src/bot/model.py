@@ -1,8 +1,18 @@
+import asyncio
+import copy
 import datetime
 import importlib
 import inspect
+import logging
+import random
+import string
+from typing import List
+from typing import Tuple
 
 from config import config
+from bot.notify import get_notifier
+from bot.util import dict_get
+from utils.cache import DocumentCache
 
 
 class ModelNotFound(Exception):
@@ -14,9 +24,166 @@ class ModelNotFound(Exception):
         super(ModelNotFound, self).__init__(message)
 
 
+def get_query_id(query: dict):
+    '''
+    Returns id if query is a lookup by id only
+    '''
+    if query and len(query) == 1 and 'id' in query and \
+       not isinstance(query['id'], dict):
+        return query['id']
+
+
+def current_task():
+    try:
+        # asyncio.current_task() appeared in python 3.7
+        if hasattr(asyncio, 'current_task'):
+            return asyncio.current_task()
+        return asyncio.Task.current_task()
+    except RuntimeError:
+        return
+
+
+def get_query_fields(query: dict, prefix=''):
+    '''
+    Returns (dotted) names of fields used in query
+    '''
+    fields = []
+    for k, value in query.items():
+        if k[0] == '$':
+            continue
+        if isinstance(value, dict) and value and \
+           not any(key[0] == '$' for key in value):
+            fields.extend(get_query_fields(value, prefix + k + '.'))
+        else:
+            fields.append(prefix + k)
+    return fields
+
+
+class Index:
+    '''
+    Index declaration for Model.indexes. Keys are field names (equality
+    lookups) or (field, direction) pairs (range queries and sorting), several
+    keys make compound index.
+
+    Args:
+        ttl: storage removes document in `ttl` seconds after datetime value
+            of the first key
+        partial: only documents matched this query are indexed
+    '''
+
+    def __init__(self, *keys, ttl=None, partial: dict=None):
+        self.keys = [k if isinstance(k, str) else tuple(k) for k in keys]
+        self.ttl = ttl
+        self.partial = partial
+
+    @classmethod
+    def from_spec(cls, spec):
+        '''
+        Accepts Index, field name or (field, direction) pair
+        '''
+        if isinstance(spec, Index):
+            return spec
+        return cls(spec)
+
+    @property
+    def fields(self) -> List[str]:
+        return [k if isinstance(k, str) else k[0] for k in self.keys]
+
+    @property
+    def name(self) -> str:
+        return '__'.join(f.replace('.', '__') for f in self.fields)
+
+    def covers(self, fields: List[str], sort_field: str=None):
+        '''
+        Whether the index can be used by query on given fields (ordered by
+        sort_field)
+        '''
+        if self.partial and \
+           not set(get_query_fields(self.partial)).issubset(fields):
+            return False
+        return self.fields[0] in fields or self.fields[0] == sort_field
+
+    def __repr__(self):
+        return 'Index({0})'.format(', '.join(repr(k) for k in self.keys))
+
+
+class UnitOfWork:
+    '''
+    Identity map for models loaded by id within one asyncio task (e.g. while
+    handling one telegram update). Repeated Model.aget({'id': ...}) calls
+    return the same object without storage round trips, Model.asave() of
+    mapped models is deferred and all changes are saved once on exit.
+
+    Usage:
+        async with UnitOfWork():
+            user = await User.aget({'id': user_id})
+            ...
+    '''
+
+    _by_task = {}
+
+    def __init__(self):
+        self._models = {}
+        self._task = None
+
+    @classmethod
+    def current(cls):
+        task = current_task()
+        if task is not None:
+            return cls._by_task.get(task)
+
+    async def __aenter__(self):
+        self._task = current_task()
+        self._by_task[self._task] = self
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.flush()
+        finally:
+            del self._by_task[self._task]
+
+    def get(self, model_class, query: dict):
+        model_id = get_query_id(query)
+        if model_id is not None:
+            return self._models.get((model_class, model_id))
+
+    def add(self, model):
+        self._models[(model.__class__, model.id)] = model
+
+    def remove(self, model):
+        self._models.pop((model.__class__, model.id), None)
+
+    def __contains__(self, model):
+        key = (model.__class__, getattr(model, 'id', None))
+        return self._models.get(key) is model
+
+    async def flush(self):
+        for model in list(self._models.values()):
+            await model._asave()
+
+
 class Model:
 
     storage = None
+    async_storage = None
+    # fields which are used in queries (besides "id"). Use (field, direction)
+    # pair for fields used in range queries and sorting and Index for
+    # compound, TTL and partial indexes
+    indexes = []
+    # keep only this number of the latest inserted documents (capped
+    # collection in MongoDB, it also needs max_size in bytes)
+    max_documents = None
+    max_size = None
+    # (model name, query fields, sort field) of queries checked by
+    # _check_indexed()
+    checked_queries = set()
+    # cache documents loaded by id (see utils.cache.DocumentCache)
+    use_cache = False
+    # in-process tier of the cache, may serve stale documents changed by
+    # other processes for cache.local_ttl seconds
+    local_cache = True
+    cache = None
 
     def __init__(self, **kwargs):
         self.id = None
@@ -37,10 +204,93 @@ class Model:
         module = importlib.import_module(module_name)
         for name, klass in inspect.getmembers(module):
             if name == classname:
-                cls.storage = klass(storage_info, collection=collection)
+                cls.storage = klass(storage_info, collection=collection,
+                                    indexes=cls.indexes,
+                                    max_documents=cls.max_documents,
+                                    max_size=cls.max_size)
                 return cls.storage
         raise Exception('Class {0} not found'.format(storage_info['class']))
 
+    @classmethod
+    def ensure_indexes(cls):
+        '''
+        Creates declared indexes in storage (existing ones are kept)
+        '''
+        cls.__get_storage().ensure_indexes()
+
+    @classmethod
+    def _check_indexed(cls, query: dict, sort: List[Tuple]=None):
+        '''
+        Logs a warning (once per query shape) about queries which can't use
+        any of declared indexes
+        '''
+        if not query and not sort:
+            return
+        fields = tuple(sorted(get_query_fields(query or {})))
+        sort_field = sort[0][0] if sort else None
+        key = (cls.__name__, fields, sort_field)
+        if key in cls.checked_queries:
+            return
+        cls.checked_queries.add(key)
+        if 'id' in fields:
+            return
+        indexes = [Index.from_spec(spec) for spec in cls.indexes]
+        if not any(index.covers(fields, sort_field) for index in indexes):
+            logging.getLogger('storage').warning(
+                'Unindexed query on {0}: fields {1}, sort {2}'.format(
+                    cls.__name__, list(fields), sort_field))
+
+    @classmethod
+    def __get_cache(cls) -> DocumentCache:
+        if not cls.use_cache:
+            return
+        collection = cls.__name__.lower()
+        if not cls.cache or cls.cache.name != collection:
+            prefix = '{0}:'.format(config['project_name'])
+            cls.cache = DocumentCache.from_config(collection,
+                                                  config.get('cache', {}),
+                                                  prefix=prefix,
+                                                  local=cls.local_cache)
+        if cls.cache.enabled:
+            return cls.cache
+
+    def _invalidate_cache(self):
+        cache = self.__get_cache()
+        if cache is not None and getattr(self, 'id', None) is not None:
+            cache.invalidate(self.id)
+
+    async def _adelete_from_cache(self):
+        cache = self.__get_cache()
+        if cache is not None and getattr(self, 'id', None) is not None:
+            await cache.delete(self.id)
+
+    @classmethod
+    def __get_async_storage(cls):
+        storage = cls.__get_storage()
+        if cls.async_storage and cls.async_storage.storage is storage:
+            return cls.async_storage
+        from bot.storage import AsyncStorage
+        cls.async_storage = AsyncStorage(storage)
+        return cls.async_storage
+
+    @classmethod
+    def from_document(cls, document: dict, fields: List[str]=None):
+        '''
+        Creates model from storage document. If document was loaded with
+        projection (fields), model is partially populated and constructor
+        is not called
+        '''
+        if fields is None:
+            model = cls(**document)
+        else:
+            model = cls.__new__(cls)
+            model.id = None
+            for name, value in document.items():
+                setattr(model, name, value)
+            model._fields = fields
+        model._take_snapshot()
+        return model
+
     @classmethod
     def create(cls, **kwargs):
         model = cls(**kwargs)
@@ -49,37 +299,113 @@ class Model:
         return model
 
     @classmethod
-    def get(cls, query: dict):
-        document = cls.__get_storage().get(query)
+    def get(cls, query: dict, *, fields: List[str]=None):
+        cls._check_indexed(query)
+        document = cls.__get_storage().get(query, fields=fields)
         if not document:
             raise ModelNotFound(query)
-        return cls(**document)
+        return cls.from_document(document, fields)
 
     @classmethod
-    def find(cls, query: dict=None, sort=None, skip=None, limit=None):
+    def find(cls, query: dict=None, sort=None, skip=None, limit=None, *,
+             lazy=False, batch_size=None, fields: List[str]=None):
+        '''
+        Returns list of models. With lazy=True returns iterator, which
+        fetches documents from storage on demand (by batch_size documents).
+        With fields returns partially populated models (see from_document)
+        '''
         query = query or {}
         sort = sort or []
-        entries = cls.__get_storage().find(query, sort, skip, limit)
-        return [cls(**doc) for doc in entries]
+        cls._check_indexed(query, sort)
+        entries = cls.__get_storage().find(query, sort, skip, limit,
+                                           batch_size, fields=fields)
+        if lazy:
+            return (cls.from_document(doc, fields) for doc in entries)
+        return [cls.from_document(doc, fields) for doc in entries]
 
     @classmethod
     def find_and_modify(cls, query, update, sort=None):
+        cls._check_indexed(query, sort)
         document = cls.__get_storage().find_and_modify(query, update, sort)
         if document:
-            return cls(**document)
+            return cls.from_document(document)
+
+    @classmethod
+    def claim(cls, query: dict, new_values: dict, sort=None, limit=100,
+              increment: dict=None):
+        '''
+        Marks at most `limit` documents matched query with new_values (and
+        unique "claim_id") in one storage request, fields of `increment` are
+        incremented. Returns list of models
+        '''
+        cls._check_indexed(query, sort)
+        documents = cls.__get_storage().claim(query, new_values, sort or [],
+                                              limit, increment)
+        return [cls.from_document(document) for document in documents]
+
+    def _update_data(self) -> dict:
+        '''
+        Data to update stored document with. Nested fields loaded with
+        dotted projection are saved by their paths
+        '''
+        data = self.save_data()
+        data.pop('id', None)
+        if getattr(self, '_fields', None) is None:
+            return data
+        result = {}
+        for name, value in data.items():
+            nested = [f for f in self._fields if f.startswith(name + '.')]
+            if not nested or not isinstance(value, dict):
+                result[name] = value
+                continue
+            for field in nested:
+                nested_value = dict_get(data, field.split('.'))
+                if nested_value is not None:
+                    result[field] = nested_value
+        return result
+
+    def _take_snapshot(self):
+        self._snapshot = copy.deepcopy(self._update_data())
+
+    def get_changes(self) -> dict:
+        '''
+        Returns fields changed since model was loaded or saved last time.
+        Returns None for model which was never loaded or saved
+        '''
+        snapshot = getattr(self, '_snapshot', None)
+        if snapshot is None:
+            return
+        return {
+            k: v for k, v in self._update_data().items()
+            if k not in snapshot or snapshot[k] != v
+        }
 
     def save(self):
-        self.__get_storage().save(self)
+        storage = self.__get_storage()
+        changes = self.get_changes()
+        if changes is None or not getattr(self, 'id', None):
+            storage.save(self)
+        elif not changes:
+            return
+        elif not storage.update({'id': self.id}, changes):
+            # document was deleted, loaded model must not insert it again
+            # (projected one would insert partial document)
+            raise ModelNotFound({'id': self.id})
+        self._invalidate_cache()
+        self._take_snapshot()
 
     def update(self, query: dict, new_values: dict):
         query['id'] = self.id
-        document = self.__get_storage().update(query, new_values)
+        document = self.__get_storage().find_and_modify(
+            query, {'$set': new_values})
+        self._invalidate_cache()
         if not document:
             raise ModelNotFound()
-        return self.__class__(**document)
+        return self.from_document(document)
 
     def delete(self):
         self.__get_storage().delete(self)
+        self._invalidate_cache()
 
     def save_data(self) -> dict:
         data = {}
@@ -95,13 +421,209 @@ class Model:
                 data[field] = val
         return data
 
+    @classmethod
+    def bulk_save(cls, models: List['Model']):
+        '''
+        Saves models with one storage request (whole documents are written)
+        '''
+        cls.__get_storage().bulk_save(models)
+        for model in models:
+            model._invalidate_cache()
+            model._take_snapshot()
+
+    @classmethod
+    def bulk_update(cls, updates: List[Tuple[dict, dict]]):
+        '''
+        Args:
+            updates: list of (query, new_values) pairs. See Storage.update
+        Returns: number of updated documents
+        '''
+        count = cls.__get_storage().bulk_update(updates)
+        cache = cls.__get_cache()
+        if cache is not None:
+            for query, _ in updates:
+                model_id = get_query_id(query)
+                if model_id is not None:
+                    cache.invalidate(model_id)
+        return count
+
+    @classmethod
+    def bulk_delete(cls, models: List['Model']):
+        cls.__get_storage().bulk_delete(models)
+        for model in models:
+            model._invalidate_cache()
+
     @classmethod
     def count(cls, query=None):
-        return len(cls.find(query))
+        cls._check_indexed(query)
+        return cls.__get_storage().count(query or {})
+
+    @classmethod
+    async def acreate(cls, **kwargs):
+        model = cls(**kwargs)
+        model._created = datetime.datetime.now()
+        await model.asave()
+        return model
+
+    @classmethod
+    async def aget(cls, query: dict, *, fields: List[str]=None):
+        unit_of_work = UnitOfWork.current()
+        if unit_of_work is not None:
+            model = unit_of_work.get(cls, query)
+            if model is not None:
+                return model
+        cache = cls.__get_cache()
+        model_id = get_query_id(query)
+        document = None
+        if cache is not None and model_id is not None:
+            document = await cache.get(model_id)
+            if document is not None:
+                # cached document is complete
+                fields = None
+        if document is None:
+            cls._check_indexed(query)
+            storage = cls.__get_async_storage()
+            document = await storage.get(query, fields=fields)
+            if not document:
+                raise ModelNotFound(query)
+            if cache is not None and model_id is not None and fields is None:
+                await cache.add(model_id, document)
+        model = cls.from_document(document, fields)
+        if unit_of_work is not None and fields is None:
+            unit_of_work.add(model)
+        return model
+
+    @classmethod
+    async def afind(cls, query: dict=None, sort=None, skip=None, limit=None,
+                    *, fields: List[str]=None):
+        query = query or {}
+        sort = sort or []
+        cls._check_indexed(query, sort)
+        entries = await cls.__get_async_storage().find(query, sort, skip,
+                                                       limit, fields=fields)
+        return [cls.from_document(doc, fields) for doc in entries]
+
+    @classmethod
+    def afind_iter(cls, query: dict=None, sort=None, skip=None, limit=None,
+                   *, batch_size=100, fields: List[str]=None):
+        '''
+        Returns async iterator over models. Usage:
+            async for user in User.afind_iter({...}):
+                ...
+        '''
+        query = query or {}
+        sort = sort or []
+        cls._check_indexed(query, sort)
+        return cls.__get_async_storage().find_iter(
+            query, sort, skip, limit, batch_size, fields=fields,
+            wrapper=lambda doc: cls.from_document(doc, fields)
+        )
+
+    @classmethod
+    async def afind_and_modify(cls, query, update, sort=None):
+        cls._check_indexed(query, sort)
+        storage = cls.__get_async_storage()
+        document = await storage.find_and_modify(query, update, sort)
+        if document:
+            return cls.from_document(document)
+
+    @classmethod
+    async def aclaim(cls, query: dict, new_values: dict, sort=None,
+                     limit=100, increment: dict=None):
+        cls._check_indexed(query, sort)
+        storage = cls.__get_async_storage()
+        documents = await storage.claim(query, new_values, sort or [], limit,
+                                        increment)
+        return [cls.from_document(document) for document in documents]
+
+    async def asave(self):
+        unit_of_work = UnitOfWork.current()
+        if unit_of_work is not None and self in unit_of_work:
+            # will be saved at the end of unit of work
+            return
+        await self._asave()
+
+    async def _asave(self):
+        storage = self.__get_async_storage()
+        changes = self.get_changes()
+        if changes is None or not getattr(self, 'id', None):
+            await storage.save(self)
+        elif not changes:
+            return
+        elif not await storage.update({'id': self.id}, changes):
+            # document was deleted, see save()
+            raise ModelNotFound({'id': self.id})
+        await self._adelete_from_cache()
+        self._take_snapshot()
+
+    async def aupdate(self, query: dict, new_values: dict):
+        query['id'] = self.id
+        document = await self.__get_async_storage().find_and_modify(
+            query, {'$set': new_values})
+        await self._adelete_from_cache()
+        if not document:
+            raise ModelNotFound()
+        return self.from_document(document)
+
+    async def adelete(self):
+        unit_of_work = UnitOfWork.current()
+        if unit_of_work is not None:
+            unit_of_work.remove(self)
+        await self.__get_async_storage().delete(self)
+        await self._adelete_from_cache()
+
+    @classmethod
+    async def abulk_save(cls, models: List['Model']):
+        await cls.__get_async_storage().bulk_save(models)
+        for model in models:
+            await model._adelete_from_cache()
+            model._take_snapshot()
+
+    @classmethod
+    async def abulk_update(cls, updates: List[Tuple[dict, dict]]):
+        '''
+        Args:
+            updates: list of (query, new_values) pairs. See Storage.update
+        Returns: number of updated documents
+        '''
+        count = await cls.__get_async_storage().bulk_update(updates)
+        cache = cls.__get_cache()
+        if cache is not None:
+            for query, _ in updates:
+                model_id = get_query_id(query)
+                if model_id is not None:
+                    await cache.delete(model_id)
+        return count
+
+    @classmethod
+    async def abulk_delete(cls, models: List['Model']):
+        unit_of_work = UnitOfWork.current()
+        if unit_of_work is not None:
+            for model in models:
+                unit_of_work.remove(model)
+        await cls.__get_async_storage().bulk_delete(models)
+        for model in models:
+            await model._adelete_from_cache()
+
+    @classmethod
+    async def acount(cls, query=None):
+        unit_of_work = UnitOfWork.current()
+        if unit_of_work is not None and unit_of_work.get(cls, query or {}):
+            return 1
+        cls._check_indexed(query)
+        return await cls.__get_async_storage().count(query or {})
 
 
 class StartSession(Model):
 
+    indexes = [
+        Index('oauth_data.callback_key',
+              partial={'oauth_data.callback_key': {'$exists': True}}),
+        # sessions live for 24 hours since the last authorization request
+        # (/start or request of full access), see BaseBot. Like all TTL
+        # fields, `created` is UTC time: mongo expires documents by UTC
+        Index(('created', 1), ttl=24 * 3600),
+    ]
     save_fields = [
         'key',
         'data',
@@ -114,11 +636,23 @@ class StartSession(Model):
         self.key = key
         self.data = data
         self.oauth_data = oauth_data
-        self.created = kwargs.get('created', datetime.datetime.now())
+        self.created = kwargs.get('created', datetime.datetime.utcnow())
+
+    @staticmethod
+    def generate_key():
+        return ''.join([random.choice(string.ascii_letters + string.digits)
+                        for i in range(32)])
 
 
 class TelegramUpdate(Model):
 
+    indexes = [
+        'user_id',
+        # claim of the oldest update by dealer
+        Index('in_process', ('created', 1)),
+    ]
+    # wake up dealer when update is queued (see bot.notify)
+    notify_dealer = True
     save_fields = [
         'user_id',
         'request_type',
@@ -135,6 +669,24 @@ class TelegramUpdate(Model):
         self.status_message_id = status_message_id
         self.message = message
         self.created = kwargs.get('created', datetime.datetime.now())
+        # lease of dealer which processes the update (see bot.dealer)
+        self.worker_id = kwargs.get('worker_id')
+        self.lease_expires = kwargs.get('lease_expires')
+        self.attempts = kwargs.get('attempts', 0)
+
+    @classmethod
+    def create(cls, **kwargs):
+        update = super().create(**kwargs)
+        if cls.notify_dealer:
+            get_notifier().notify()
+        return update
+
+    @classmethod
+    async def acreate(cls, **kwargs):
+        update = await super().acreate(**kwargs)
+        if cls.notify_dealer:
+            get_notifier().notify()
+        return update
 
     def has_file(self):
         return self.request_type.lower() in [
@@ -144,6 +696,9 @@ class TelegramUpdate(Model):
 
 class TelegramUpdateLog(Model):
 
+    indexes = [('created', 1)]
+    max_documents = 100000
+    max_size = 256 * 1024 * 1024
     save_fields = [
         'created',
         'update',
@@ -158,6 +713,11 @@ class TelegramUpdateLog(Model):
 
 class FailedUpdate(TelegramUpdate):
 
+    indexes = [
+        'user_id',
+        Index(('failed_at', 1), ttl=30 * 24 * 3600),  # UTC time
+    ]
+    notify_dealer = False
     save_fields = [
         'user_id',
         'request_type',
@@ -174,7 +734,7 @@ class FailedUpdate(TelegramUpdate):
         self.request_type = request_type
         self.status_message_id = status_message_id
         self.message = message
-        self.failed_at = kwargs.get('failed_at', datetime.datetime.now())
+        self.failed_at = kwargs.get('failed_at', datetime.datetime.utcnow())
         self.error = kwargs.get('error')
         if 'error' not in self.save_fields:
             self.save_fields.append('error')
@@ -182,6 +742,11 @@ class FailedUpdate(TelegramUpdate):
 
 class User(Model):
 
+    use_cache = True
+    # users are changed by web workers and dealer, only memcached is
+    # invalidated for all of them
+    local_cache = False
+    indexes = [('last_request_time', 1)]
     save_fields = [
         'id',
         'telegram_chat_id',
@@ -211,3 +776,17 @@ class User(Model):
         self.evernote_access_token = kwargs.get('evernote_access_token')
         self.current_notebook = kwargs.get('current_notebook')
         self.settings = kwargs.get('settings', {})
+
+
+def iter_model_classes(base=Model):
+    for model_class in base.__subclasses__():
+        yield model_class
+        yield from iter_model_classes(model_class)
+
+
+def ensure_indexes():
+    '''
+    Creates declared indexes of all models. Called at startup of daemons
+    '''
+    for model_class in iter_model_classes():
+        model_class.ensure_indexes()
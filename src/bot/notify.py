@@ -0,0 +1,129 @@
+import asyncio
+import importlib
+import os
+import socket
+
+from config import config
+
+
+class LocalNotifier:
+    '''
+    Wakes up dealer when new updates are queued. Works within one process
+    only (e.g. when dealer runs in the web process or in tests)
+    '''
+
+    # whether notifications of other processes reach dealer
+    cross_process = False
+
+    def __init__(self, config: dict=None):
+        self.config = config or {}
+        self._event = None
+
+    def _get_event(self) -> asyncio.Event:
+        # event is created in the loop of the waiting side
+        if self._event is None:
+            self._event = asyncio.Event()
+        return self._event
+
+    def notify(self):
+        self._get_event().set()
+
+    async def wait(self, timeout: float):
+        '''
+        Waits for notification at most `timeout` seconds. Returns True if
+        notification was received
+        '''
+        event = self._get_event()
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        event.clear()
+        return True
+
+    def close(self):
+        pass
+
+
+class UnixSocketNotifier(LocalNotifier):
+    '''
+    Dealer listens on unix datagram socket, other processes (web) send one
+    byte per queued update. Lost datagrams (dealer is down, socket buffer
+    is full) are harmless: dealer also polls storage.
+
+    Config:
+        address: path to socket
+    '''
+
+    cross_process = True
+
+    def __init__(self, config: dict=None):
+        super().__init__(config)
+        self.address = self.config['address']
+        self._listener = None
+        self._sender = None
+        self._sender_pid = None
+
+    def notify(self):
+        if self._listener is not None:
+            super().notify()
+            return
+        if self._sender_pid != os.getpid():
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sender.setblocking(False)
+            self._sender_pid = os.getpid()
+        try:
+            self._sender.sendto(b'1', self.address)
+        except OSError:
+            pass
+
+    def listen(self):
+        if self._listener is not None:
+            return
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        listener.setblocking(False)
+        listener.bind(self.address)
+        asyncio.get_event_loop().add_reader(listener.fileno(), self._on_read)
+        self._listener = listener
+
+    def _on_read(self):
+        # many notifications wake up dealer once
+        while True:
+            try:
+                self._listener.recv(1024)
+            except (BlockingIOError, InterruptedError):
+                break
+        self._get_event().set()
+
+    async def wait(self, timeout: float):
+        self.listen()
+        return await super().wait(timeout)
+
+    def close(self):
+        if self._listener is None:
+            return
+        asyncio.get_event_loop().remove_reader(self._listener.fileno())
+        self._listener.close()
+        self._listener = None
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+_notifier = None
+
+
+def get_notifier():
+    '''
+    Returns notifier from config['dealer']['notifier'] (LocalNotifier by
+    default)
+    '''
+    global _notifier
+    if _notifier is None:
+        notifier_config = config.get('dealer', {}).get('notifier', {})
+        classname = notifier_config.get('class', 'bot.notify.LocalNotifier')
+        module_name, classname = classname.rsplit('.', 1)
+        module = importlib.import_module(module_name)
+        _notifier = getattr(module, classname)(notifier_config)
+    return _notifier
@@ -1,28 +1,294 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import copy
+import datetime
+import fcntl
+import functools
+import heapq
+import itertools
+import json
+import operator
+import os
+import re
+import sqlite3
+import threading
+import logging
+import time
+import types
 import uuid
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
 from numbers import Number
 from typing import List
 from typing import Tuple
 
+from pymongo import InsertOne
 from pymongo import MongoClient
+from pymongo import ReplaceOne
+from pymongo import UpdateOne
 from pymongo.collection import Collection
 from pymongo.collection import ReturnDocument
+from pymongo.errors import CollectionInvalid
+from pymongo.errors import OperationFailure
 
+from bot.model import Index
 from bot.model import Model
 from bot.util import dict_get, dict_set
+from utils.stats import LatencyHistogram
+
+
+def project(document: dict, fields: List[str]=None):
+    '''
+    Returns copy of document with given (dotted) fields and "id" only
+    '''
+    if fields is None:
+        return document
+    result = {'id': document.get('id')}
+    for field in fields:
+        path = field.split('.')
+        value = dict_get(document, path)
+        if value is not None:
+            dict_set(result, value, path)
+    return result
+
+
+def increment_values(document: dict, new_values: dict,
+                     increment: dict=None):
+    '''
+    Returns new_values extended with (dotted) fields of document incremented
+    by values of `increment` (like $inc in mongo)
+    '''
+    if not increment:
+        return new_values
+    values = dict(new_values)
+    for field, value in increment.items():
+        values[field] = (dict_get(document, field.split('.')) or 0) + value
+    return values
+
+
+DATE_PREFIX = '$date:'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def json_encode(value):
+    '''
+    Converts document to JSON-compatible object (datetimes become strings)
+    '''
+    if isinstance(value, datetime.datetime):
+        return DATE_PREFIX + value.strftime(DATE_FORMAT)
+    if isinstance(value, dict):
+        return {k: json_encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_encode(v) for v in value]
+    return value
+
+
+def json_decode(value):
+    if isinstance(value, str) and value.startswith(DATE_PREFIX):
+        try:
+            return datetime.datetime.strptime(value[len(DATE_PREFIX):],
+                                              DATE_FORMAT)
+        except ValueError:
+            return value
+    if isinstance(value, dict):
+        return {k: json_decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [json_decode(v) for v in value]
+    return value
+
+
+def get_query_shape(query):
+    '''
+    Returns query with values replaced by "?" (keys and operators are kept)
+    '''
+    if isinstance(query, dict):
+        return {k: get_query_shape(v) for k, v in query.items()}
+    return '?'
+
+
+class StorageStats:
+    '''
+    Latency histograms and error counters of storage operations (by
+    collection and operation) in current process
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._errors = {}
+
+    def add(self, collection: str, operation: str, duration: float,
+            error=False):
+        key = (collection, operation)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+            histogram.add(duration)
+            if error:
+                self._errors[key] = self._errors.get(key, 0) + 1
+
+    def get(self) -> List[dict]:
+        '''
+        Returns list of stats (times in milliseconds) sorted by total time
+        '''
+        result = []
+        with self._lock:
+            for (collection, operation), h in self._histograms.items():
+                result.append({
+                    'collection': collection,
+                    'operation': operation,
+                    'count': h.count,
+                    'errors': self._errors.get((collection, operation), 0),
+                    'total_ms': h.total * 1000,
+                    'mean_ms': h.mean * 1000,
+                    'p50_ms': h.percentile(0.5) * 1000,
+                    'p95_ms': h.percentile(0.95) * 1000,
+                    'p99_ms': h.percentile(0.99) * 1000,
+                    'max_ms': h.max * 1000,
+                })
+        return sorted(result, key=lambda x: x['total_ms'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._errors = {}
+
+
+storage_stats = StorageStats()
 
 
 class Storage:
 
+    # Whether methods of this storage do network/disk I/O and should be
+    # called from a thread pool by AsyncStorage
+    blocking = True
+    # operations measured by storage_stats, the first argument of
+    # query_operations is logged for slow calls
+    instrumented = ('get', 'find', 'find_and_modify', 'claim', 'count',
+                    'save', 'update', 'delete', 'bulk_save', 'bulk_update',
+                    'bulk_delete')
+    query_operations = ('get', 'find', 'find_and_modify', 'claim', 'count',
+                        'update')
+    _calls = threading.local()
+
     def __init__(self, config, **kwargs):
         self.config = config
         self.collection = kwargs['collection']
+        self.indexes = kwargs.get('indexes', [])
+        # retention policy, see Model.max_documents
+        self.max_documents = kwargs.get('max_documents')
+        self.max_size = kwargs.get('max_size')
+        # (field, seconds) pairs from TTL indexes
+        self.expiration = [
+            (index.fields[0], index.ttl)
+            for index in map(Index.from_spec, self.indexes)
+            if index.ttl is not None
+        ]
+        self._next_sweep = 0
+        for operation in self.instrumented:
+            method = getattr(self, operation)
+            setattr(self, operation, self._instrument(operation, method))
+
+    @abstractmethod
+    def create_index(self, spec):
+        '''
+        Creates index if it doesn't exist
+
+        Args:
+            spec: Index, field name or (field, direction) pair
+        '''
+        pass
+
+    def ensure_indexes(self):
+        for spec in self.indexes:
+            self.create_index(spec)
+
+    def _instrument(self, operation: str, method):
+        @functools.wraps(method)
+        def instrumented(*args, **kwargs):
+            calls = self._calls
+            if getattr(calls, 'active', False):
+                # called by another operation (e.g. find in find_and_modify)
+                return method(*args, **kwargs)
+            calls.active = True
+            start = time.monotonic()
+            error = True
+            try:
+                result = method(*args, **kwargs)
+                error = False
+            finally:
+                calls.active = False
+                if error:
+                    self._record(operation, args, time.monotonic() - start,
+                                 error)
+            elapsed = time.monotonic() - start
+            if isinstance(result, types.GeneratorType):
+                # documents are fetched lazily, measure iteration too
+                return self._timed_iter(operation, args, result, elapsed)
+            self._record(operation, args, elapsed)
+            return result
+        return instrumented
+
+    def _timed_iter(self, operation: str, args, iterator, elapsed: float):
+        error = True
+        try:
+            while True:
+                start = time.monotonic()
+                self._calls.active = True
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    self._calls.active = False
+                    elapsed += time.monotonic() - start
+                yield item
+            error = False
+        except GeneratorExit:
+            error = False
+            raise
+        finally:
+            self._record(operation, args, elapsed, error)
+
+    def _record(self, operation: str, args, duration: float, error=False):
+        storage_stats.add(self.collection, operation, duration, error)
+        slow_query_time = self.config.get('slow_query_ms', 100) / 1000
+        if duration < slow_query_time:
+            return
+        query = None
+        if operation in self.query_operations and args:
+            query = get_query_shape(args[0])
+        logging.getLogger('storage').warning(
+            'Slow {0} on {1} ({2:.1f} ms), query {3}'.format(
+                operation, self.collection, duration * 1000, query))
+
+    def _sweep_due(self):
+        '''
+        Whether it's time to remove expired documents (storages without
+        native TTL check it on writes every `sweep_interval` seconds)
+        '''
+        if not self.expiration and not self.max_documents:
+            return False
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return False
+        self._next_sweep = now + self.config.get('sweep_interval', 60)
+        return True
+
+    def _get_expiration_time(self, ttl):
+        # TTL fields store UTC time (datetime.utcnow()) like mongo expects
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
 
     @abstractmethod
-    def get(self, query: dict):
+    def get(self, query: dict, fields: List[str]=None):
         '''
         Args:
             query:
+            fields: if set, only these fields (and "id") are returned
 
         Returns: one model object that matched query
         '''
@@ -39,6 +305,7 @@ class Storage:
         Args:
             query:
             new_values: float dict. For nested fields use dots, example: 'field1.field2.field3'
+        Returns: false value if no document matched
         '''
         pass
 
@@ -47,62 +314,810 @@ class Storage:
         pass
 
     @abstractmethod
-    def find(self, query: dict, sort: List[Tuple], skip=None, limit=None):
+    def find(self, query: dict, sort: List[Tuple], skip=None, limit=None,
+             batch_size=None, fields: List[str]=None):
+        '''
+        Returns iterable over documents matched query. batch_size is a hint
+        how many documents to fetch from a server per round trip. If fields
+        is set, only these fields (and "id") are returned
+        '''
         pass
 
     @abstractmethod
     def find_and_modify(self, query, update, sort=None):
         pass
 
+    def claim(self, query: dict, new_values: dict, sort: List[Tuple],
+              limit: int, increment: dict=None):
+        '''
+        Sets new_values and unique "claim_id" to at most `limit` first (by
+        sort) documents matched query, top-level fields of `increment` are
+        incremented by given values. Returns updated documents
+        '''
+        update = {'$set': dict(new_values, claim_id=uuid.uuid4().hex)}
+        if increment:
+            update['$inc'] = increment
+        documents = []
+        while len(documents) < limit:
+            document = self.find_and_modify(query, update, sort)
+            if not document:
+                break
+            documents.append(document)
+        return documents
+
+    def bulk_save(self, models: List[Model]):
+        for model in models:
+            self.save(model)
+
+    def bulk_update(self, updates: List[Tuple[dict, dict]]):
+        '''
+        Applies list of (query, new_values) pairs (see update()). Returns
+        number of updated documents
+        '''
+        return sum(1 for query, new_values in updates
+                   if self.update(query, new_values))
+
+    def bulk_delete(self, models: List[Model]):
+        for model in models:
+            self.delete(model)
+
+    @abstractmethod
+    def count(self, query: dict):
+        '''
+        Returns number of documents matched query
+        '''
+        pass
+
+
+class AsyncCursor:
+    '''
+    Async iterator over documents returned by Storage.find(). Documents are
+    fetched from the underlying (possibly blocking) iterator in batches
+    '''
+
+    def __init__(self, async_storage, documents, batch_size=100,
+                 wrapper=None):
+        self._async_storage = async_storage
+        self._documents = iter(documents)
+        self._batch_size = batch_size
+        self._wrapper = wrapper
+        self._batch = []
+        self._exhausted = False
+
+    def _fetch_batch(self):
+        return list(itertools.islice(self._documents, self._batch_size))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._batch:
+            if not self._exhausted:
+                self._batch = await self._async_storage._call(
+                    self._fetch_batch)
+                self._batch.reverse()
+                self._exhausted = len(self._batch) < self._batch_size
+            if not self._batch:
+                raise StopAsyncIteration
+        document = self._batch.pop()
+        if self._wrapper is not None:
+            return self._wrapper(document)
+        return document
+
+
+class AsyncStorage:
+    '''
+    Async counterpart of Storage. Blocking storages are called in a bounded
+    thread pool shared by the whole process, so slow queries don't stall
+    the event loop. Non-blocking storages are called directly.
+    '''
+
+    _executor = None
+    _executor_pid = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, storage: Storage, *, loop=None):
+        self.storage = storage
+        self.collection = storage.collection
+        self._loop = loop
+
+    @classmethod
+    def get_executor(cls, max_workers=10) -> ThreadPoolExecutor:
+        with cls._executor_lock:
+            # threads of the pool don't survive fork()
+            if cls._executor is None or cls._executor_pid != os.getpid():
+                cls._executor = ThreadPoolExecutor(max_workers=max_workers)
+                cls._executor_pid = os.getpid()
+            return cls._executor
+
+    async def _call(self, method, *args, **kwargs):
+        if not self.storage.blocking:
+            return method(*args, **kwargs)
+        loop = self._loop or asyncio.get_event_loop()
+        max_workers = self.storage.config.get('async_workers', 10)
+        return await loop.run_in_executor(
+            self.get_executor(max_workers),
+            functools.partial(method, *args, **kwargs)
+        )
+
+    async def get(self, query: dict, fields: List[str]=None):
+        return await self._call(self.storage.get, query, fields=fields)
+
+    async def save(self, model: Model):
+        return await self._call(self.storage.save, model)
+
+    async def update(self, query: dict, new_values: dict):
+        return await self._call(self.storage.update, query, new_values)
+
+    async def delete(self, model: Model):
+        return await self._call(self.storage.delete, model)
+
+    async def find(self, query: dict, sort: List[Tuple], skip=None,
+                   limit=None, batch_size=None, fields: List[str]=None):
+        def find_all():
+            return list(self.storage.find(query, sort, skip, limit,
+                                          batch_size, fields=fields))
+        return await self._call(find_all)
+
+    def find_iter(self, query: dict, sort: List[Tuple], skip=None,
+                  limit=None, batch_size=100, fields: List[str]=None,
+                  wrapper=None) -> AsyncCursor:
+        '''
+        Returns async iterator over matched documents. The query is executed
+        on the first iteration step
+        '''
+        def documents():
+            yield from self.storage.find(query, sort, skip, limit,
+                                         batch_size, fields=fields)
+        return AsyncCursor(self, documents(), batch_size, wrapper)
+
+    async def find_and_modify(self, query, update, sort=None):
+        return await self._call(self.storage.find_and_modify, query, update,
+                                sort)
+
+    async def count(self, query: dict):
+        return await self._call(self.storage.count, query)
+
+    async def claim(self, query: dict, new_values: dict, sort: List[Tuple],
+                    limit: int, increment: dict=None):
+        return await self._call(self.storage.claim, query, new_values, sort,
+                                limit, increment)
+
+    async def bulk_save(self, models: List[Model]):
+        return await self._call(self.storage.bulk_save, models)
+
+    async def bulk_update(self, updates: List[Tuple[dict, dict]]):
+        return await self._call(self.storage.bulk_update, updates)
+
+    async def bulk_delete(self, models: List[Model]):
+        return await self._call(self.storage.bulk_delete, models)
+
+
+class HashIndex:
+    '''
+    Secondary index of MemoryStorage. Maps value of a (dotted) field to ids
+    of documents with this value. Documents with unhashable value of the
+    field are returned by every lookup, so callers must check candidates
+    with the query anyway.
+    '''
+
+    def __init__(self, key: str):
+        self.key = key
+        self.path = key.split('.')
+        self._ids = {}
+        self._values = {}
+        self._unhashable = {}
+
+    def add(self, doc_id, document: dict):
+        value = dict_get(document, self.path)
+        try:
+            ids = self._ids.setdefault(value, {})
+        except TypeError:
+            self._unhashable[doc_id] = True
+            return
+        ids[doc_id] = True
+        self._values[doc_id] = value
+
+    def remove(self, doc_id):
+        self._unhashable.pop(doc_id, None)
+        if doc_id not in self._values:
+            return
+        value = self._values.pop(doc_id)
+        ids = self._ids[value]
+        del ids[doc_id]
+        if not ids:
+            del self._ids[value]
+
+    def lookup(self, value):
+        '''
+        Returns list of candidate ids or None if value can't be looked up
+        '''
+        try:
+            ids = self._ids.get(value, {})
+        except TypeError:
+            return
+        return list(ids) + list(self._unhashable)
+
+    def count(self, query_value):
+        '''
+        Returns number of documents matched query_value or None if it can't
+        be counted with the index only
+        '''
+        if self._unhashable:
+            return
+        if query_value == {'$exists': False}:
+            query_value = None
+        elif isinstance(query_value, dict):
+            return
+        try:
+            return len(self._ids.get(query_value, {}))
+        except TypeError:
+            return
+
+    def select(self, query_value):
+        '''
+        Returns tuple (candidate ids, ids are ordered by value) or
+        (None, False) if the index can't be used for query_value
+        '''
+        if not isinstance(query_value, dict):
+            return self.lookup(query_value), False
+        if query_value == {'$exists': False}:
+            return self.lookup(None), False
+        if list(query_value) == ['$in']:
+            ids = {}
+            for value in query_value['$in']:
+                value_ids = self.lookup(value)
+                if value_ids is None:
+                    return None, False
+                ids.update(dict.fromkeys(value_ids, True))
+            return list(ids), False
+        return None, False
+
+
+class SortedIndex:
+    '''
+    Ordered secondary index of MemoryStorage. Keeps values of a (dotted)
+    field in a sorted list, so equality, range and ordered lookups are done
+    with bisect. Documents without the field are kept separately and go
+    first in ascending order (like in MongoDB).
+    '''
+
+    range_operators = ('$gt', '$gte', '$lt', '$lte')
+
+    def __init__(self, key: str):
+        self.key = key
+        self.path = key.split('.')
+        self._keys = []
+        self._ids = []
+        self._values = {}
+        self._missing = {}
+        # documents whose value can't be compared with other values
+        self._unsortable = {}
+
+    def add(self, doc_id, document: dict):
+        value = dict_get(document, self.path)
+        if value is None:
+            self._missing[doc_id] = True
+            return
+        try:
+            pos = bisect.bisect_right(self._keys, value)
+        except TypeError:
+            self._unsortable[doc_id] = True
+            return
+        self._keys.insert(pos, value)
+        self._ids.insert(pos, doc_id)
+        self._values[doc_id] = value
+
+    def remove(self, doc_id):
+        self._missing.pop(doc_id, None)
+        self._unsortable.pop(doc_id, None)
+        if doc_id not in self._values:
+            return
+        value = self._values.pop(doc_id)
+        pos = bisect.bisect_left(self._keys, value)
+        while self._ids[pos] != doc_id:
+            pos += 1
+        del self._keys[pos]
+        del self._ids[pos]
+
+    def bounds(self, conditions: dict):
+        '''
+        Returns positions (lo, hi) of values matched by range conditions
+        or None if conditions can't be served by the index
+        '''
+        lo, hi = 0, len(self._keys)
+        try:
+            for operator, value in conditions.items():
+                if operator == '$gt':
+                    lo = max(lo, bisect.bisect_right(self._keys, value))
+                elif operator == '$gte':
+                    lo = max(lo, bisect.bisect_left(self._keys, value))
+                elif operator == '$lt':
+                    hi = min(hi, bisect.bisect_left(self._keys, value))
+                elif operator == '$lte':
+                    hi = min(hi, bisect.bisect_right(self._keys, value))
+                else:
+                    return
+        except TypeError:
+            return
+        return lo, max(lo, hi)
+
+    def ordered_ids(self, reverse=False):
+        '''
+        Returns iterator over all ids in order of values
+        '''
+        if reverse:
+            return itertools.chain(reversed(list(self._unsortable)),
+                                   reversed(self._ids),
+                                   reversed(list(self._missing)))
+        return itertools.chain(self._missing, self._ids, self._unsortable)
+
+    def count(self, query_value):
+        '''
+        Returns number of documents matched query_value or None if it can't
+        be counted with the index only
+        '''
+        if self._unsortable:
+            return
+        if query_value is None or query_value == {'$exists': False}:
+            return len(self._missing)
+        if not isinstance(query_value, dict):
+            query_value = {'$gte': query_value, '$lte': query_value}
+        positions = self.bounds(query_value)
+        if positions is None:
+            return
+        lo, hi = positions
+        return hi - lo
+
+    def select(self, query_value):
+        '''
+        Returns tuple (candidate ids, ids are ordered by value) or
+        (None, False) if the index can't be used for query_value
+        '''
+        ordered = not self._unsortable
+        if not isinstance(query_value, dict):
+            if query_value is None:
+                return list(self._missing), ordered
+            conditions = {'$gte': query_value, '$lte': query_value}
+        elif query_value == {'$exists': False}:
+            return list(self._missing), ordered
+        elif list(query_value) == ['$in']:
+            ids = {}
+            for value in query_value['$in']:
+                value_ids, _ = self.select(value)
+                if value_ids is None:
+                    return None, False
+                ids.update(dict.fromkeys(value_ids, True))
+            return list(ids), False
+        else:
+            conditions = query_value
+        positions = self.bounds(conditions)
+        if positions is None:
+            return None, False
+        lo, hi = positions
+        return self._ids[lo:hi] + list(self._unsortable), ordered
+
+
+def _private_opener(path, flags):
+    # documents contain access tokens, daemons run with umask 0
+    return os.open(path, flags, 0o600)
+
+
+class MemoryJournal:
+    '''
+    Append-only log of MemoryStorage writes for one collection. Every
+    `snapshot_interval` records the whole collection is written to a
+    snapshot file and the log starts over, so replay at startup stays short.
+    Journal is locked by one process, processes which share documents
+    should use SharedMemoryStorage.
+    '''
+
+    def __init__(self, directory: str, collection: str,
+                 snapshot_interval=10000, fsync=False):
+        self.journal_path = os.path.join(directory,
+                                         '{0}.journal'.format(collection))
+        self.snapshot_path = os.path.join(directory,
+                                          '{0}.snapshot'.format(collection))
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self.records = 0
+        self._file = None
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        lock_path = os.path.join(directory, '{0}.lock'.format(collection))
+        self._lock_file = open(lock_path, 'a', opener=_private_opener)
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise Exception(
+                'Journal {0} is used by another process'.format(lock_path))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._lock_file.close()
+
+    def load(self) -> dict:
+        '''
+        Returns documents (id -> document) from snapshot and log. Log is cut
+        off at the first incomplete or corrupt record
+        '''
+        logger = logging.getLogger('storage')
+        # insertion order is kept for eviction of capped collections
+        items = collections.OrderedDict()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        document = json_decode(json.loads(line))
+                    except ValueError:
+                        logger.error('Corrupt record in {0}: {1}'.format(
+                            self.snapshot_path, line))
+                        continue
+                    items[document['id']] = document
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb+') as f:
+                position = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            # last record was not written completely
+                            raise ValueError('Incomplete record')
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # cut it off so new records aren't glued to it
+                        logger.error('Corrupt record in {0}: {1}'.format(
+                            self.journal_path, line))
+                        f.truncate(position)
+                        break
+                    if record['op'] == 'save':
+                        items[record['id']] = json_decode(record['doc'])
+                    else:
+                        items.pop(record['id'], None)
+                    self.records += 1
+                    position += len(line)
+        return items
+
+    def append(self, op: str, doc_id, document: dict=None):
+        if self._file is None:
+            self._file = open(self.journal_path, 'a', encoding='utf-8',
+                              opener=_private_opener)
+        record = {'op': op, 'id': doc_id}
+        if document is not None:
+            record['doc'] = json_encode(document)
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.records += 1
+
+    def snapshot(self, items: dict):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8',
+                  opener=_private_opener) as f:
+            for document in items.values():
+                line = json.dumps(json_encode(document), ensure_ascii=False)
+                f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # replay of old records over new snapshot gives the same result,
+        # so crash before truncation is harmless
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.journal_path, 'w', encoding='utf-8',
+                          opener=_private_opener)
+        self.records = 0
+
 
 class MemoryStorage(Storage):
+    '''
+    Keeps documents in memory of current process.
+
+    Config:
+        journal_dir: if set, writes are logged to this directory and
+            collections are restored from it at startup
+        snapshot_interval: records in log between snapshots (default 10000)
+        journal_fsync: fsync log after each write (default False)
+        sweep_interval: seconds between removals of documents expired by
+            TTL indexes, checked on writes (default 60)
+    '''
 
     _items = {}
+    _indexes = {}
+    _journals = {}
+    _predicates = {}
+    blocking = False
+    lock = threading.RLock()
 
     def __init__(self, config, **kwargs):
         super().__init__(config, **kwargs)
+        if config.get('journal_dir') and \
+                self.collection not in self._journals:
+            self._open_journal()
+        if self.collection in self._journals:
+            # writes go to disk, so AsyncStorage calls the storage in
+            # threads and calls are serialized with the lock
+            self.blocking = True
+            for operation in self.instrumented:
+                method = getattr(self, operation)
+                setattr(self, operation, self._locked(method))
+        self.ensure_indexes()
+
+    def _locked(self, method):
+        @functools.wraps(method)
+        def locked(*args, **kwargs):
+            with self.lock:
+                return method(*args, **kwargs)
+        return locked
+
+    def _open_journal(self):
+        journal = MemoryJournal(
+            self.config['journal_dir'], self.collection,
+            snapshot_interval=self.config.get('snapshot_interval', 10000),
+            fsync=self.config.get('journal_fsync', False)
+        )
+        items = journal.load()
+        if items:
+            self._items[self.collection] = items
+        # indexes are rebuilt by create_index() with restored documents
+        self._indexes.pop(self.collection, None)
+        self._journals[self.collection] = journal
+
+    def _log(self, op: str, doc_id, document: dict=None):
+        journal = self._journals.get(self.collection)
+        if journal is None:
+            return
+        journal.append(op, doc_id, document)
+        if journal.records >= journal.snapshot_interval:
+            journal.snapshot(self._items.get(self.collection, {}))
+
+    def create_index(self, spec):
+        # every field of compound index is indexed separately, planner
+        # uses the most selective one. Partial indexes contain all documents
+        for key in Index.from_spec(spec).keys:
+            self._create_field_index(key)
+
+    def _create_field_index(self, key):
+        indexes = self._indexes.setdefault(self.collection, {})
+        if isinstance(key, str):
+            index = HashIndex(key)
+        else:
+            # (key, direction) pair like in MongoDB index specification
+            key = key[0]
+            index = SortedIndex(key)
+        if key in indexes:
+            return
+        for doc_id, obj in self._items.get(self.collection, {}).items():
+            index.add(doc_id, obj)
+        indexes[key] = index
+
+    def _add_to_indexes(self, doc_id, document: dict):
+        for index in self._indexes.get(self.collection, {}).values():
+            index.add(doc_id, document)
 
-    def _check_query(self, entry: dict, query: dict):
-        matched = True
+    def _remove_from_indexes(self, doc_id):
+        for index in self._indexes.get(self.collection, {}).values():
+            index.remove(doc_id)
+
+    def _plan(self, query: dict, sort: List[Tuple]=None, limit=None):
+        '''
+        Query planner. Returns tuple (ids, ordered): ids of documents
+        which may match query, chosen with the primary key or the most
+        selective index (None means full scan), and whether these ids are
+        already in order of `sort` (by one field)
+        '''
+        items = self._items.get(self.collection, {})
+        indexes = self._indexes.get(self.collection, {})
+        candidates = None
+        ordered_by = None
+        for k, query_value in query.items():
+            if k == 'id' and not isinstance(query_value, dict):
+                try:
+                    ids = [query_value] if query_value in items else []
+                except TypeError:
+                    continue
+                return ids, False
+            if k == 'id' and list(query_value) == ['$in']:
+                try:
+                    ids = [x for x in dict.fromkeys(query_value['$in'])
+                           if x in items]
+                except TypeError:
+                    continue
+                return ids, False
+            index = indexes.get(k)
+            if index is None:
+                continue
+            ids, ordered = index.select(query_value)
+            if ids is not None and \
+               (candidates is None or len(ids) < len(candidates)):
+                candidates = ids
+                ordered_by = k if ordered else None
+        if not sort or len(sort) != 1:
+            return candidates, False
+        key, direction = sort[0]
+        if ordered_by == key:
+            if direction < 0:
+                candidates = reversed(candidates)
+            return candidates, True
+        index = indexes.get(key)
+        if not isinstance(index, SortedIndex) or index._unsortable:
+            return candidates, False
+        # Walking the sort index stops after `limit` matches, it is cheaper
+        # than filtering and sorting candidates when it's expected to visit
+        # fewer documents: limit * total / matched < matched
+        if candidates is None or \
+           limit is not None and limit * len(items) < len(candidates) ** 2:
+            return index.ordered_ids(reverse=direction < 0), True
+        return candidates, False
+
+    def _get_candidate_ids(self, query: dict):
+        return self._plan(query)[0]
+
+    def _iter_ids(self, ids, query: dict):
+        items = self._items.get(self.collection, {})
+        if ids is None:
+            ids = list(items)
+        match = self._get_predicate(query)
+        for doc_id in ids:
+            obj = items.get(doc_id)
+            if obj is not None and match(obj):
+                yield doc_id, obj
+
+    def _iter_matched(self, query: dict):
+        ids, _ = self._plan(query)
+        return self._iter_ids(ids, query)
+
+    @classmethod
+    def _get_predicate(cls, query: dict):
+        '''
+        Returns function(document) -> bool for query. Queries are compiled
+        once per shape (keys and operators without values), values are
+        bound to the compiled function for each call
+        '''
+        shape, values = cls._parse_query(query)
+        compiled = cls._predicates.get(shape)
+        if compiled is None:
+            if len(cls._predicates) >= 1000:
+                cls._predicates.clear()
+            compiled = cls._compile(shape, itertools.count())
+            cls._predicates[shape] = compiled
+        return lambda entry: compiled(entry, values)
+
+    @classmethod
+    def _parse_query(cls, query: dict, values: list=None):
+        if values is None:
+            values = []
+        shape = []
         for k, query_value in query.items():
             if k[0] == '$':
-                matched = self._check_operator(k, query_value, entry)
+                if k not in cls.operators:
+                    raise Exception('Unsupported operator {0}'.format(k))
+                shape.append((k, None))
+                values.append(query_value)
+            elif isinstance(query_value, dict):
+                shape.append((k, cls._parse_query(query_value, values)[0]))
             else:
-                key_path = k.split('.')
-                key_value = dict_get(entry, key_path)
-                if isinstance(query_value, dict):
-                    matched = self._check_query(key_value, query_value)
-                elif isinstance(key_value, Number) and isinstance(query_value, Number):
-                    matched = abs(key_value - query_value) < 0.00000001
-                else:
-                    matched = key_value == query_value
-            if not matched:
+                shape.append((k, isinstance(query_value, Number)))
+                values.append(query_value)
+        return tuple(shape), values
+
+    @classmethod
+    def _compile(cls, shape: tuple, counter):
+        checks = []
+        for k, subshape in shape:
+            if k[0] == '$':
+                checks.append(cls._compile_operator(k, next(counter)))
+                continue
+            getter = cls._compile_getter(k.split('.'))
+            if isinstance(subshape, tuple):
+                checks.append(cls._compile_nested(
+                    getter, cls._compile(subshape, counter)))
+            else:
+                checks.append(cls._compile_value(
+                    getter, next(counter), subshape))
+        if not checks:
+            return lambda entry, values: True
+        if len(checks) == 1:
+            return checks[0]
+
+        def check_all(entry, values):
+            for check in checks:
+                if not check(entry, values):
+                    return False
+            return True
+        return check_all
+
+    @staticmethod
+    def _compile_getter(path: List[str]):
+        if len(path) > 1:
+            return lambda entry: dict_get(entry, path)
+        key = path[0]
+        return lambda entry: entry.get(key) \
+            if isinstance(entry, dict) else None
+
+    @staticmethod
+    def _compile_nested(getter, check):
+        return lambda entry, values: check(getter(entry), values)
+
+    @staticmethod
+    def _compile_value(getter, i, is_number):
+        if not is_number:
+            return lambda entry, values: getter(entry) == values[i]
+
+        def check(entry, values):
+            key_value = getter(entry)
+            if isinstance(key_value, Number):
+                return abs(key_value - values[i]) < 0.00000001
+            return key_value == values[i]
+        return check
+
+    @classmethod
+    def _compile_operator(cls, operator, i):
+        check = cls.operators[operator]
+        return lambda entry, values: check(entry, values[i])
+
+    @staticmethod
+    def _check_in(entry, query_value):
+        if isinstance(entry, list):
+            return any(x in query_value for x in entry)
+        return entry in query_value
+
+    @staticmethod
+    def _compare(compare):
+        def check(entry, query_value):
+            if entry is None:
+                return False
+            try:
+                return compare(entry, query_value)
+            except TypeError:
                 return False
-        return matched
+        return check
 
-    def _check_operator(self, operator, query_value, entry):
-        if operator == '$exists':
-            return (entry is not None) == query_value
-        raise Exception('Unsupported operator {0}'.format(operator))
+    def get(self, query: dict, fields: List[str]=None):
+        for doc_id, obj in self._iter_matched(query):
+            return copy.deepcopy(project(obj, fields))
 
-    def get(self, query: dict):
-        for k, obj in self._items.get(self.collection, {}).items():
-            if self._check_query(obj, query):
-                return obj
-
-    def find(self, query: dict, sort: List[Tuple], skip=None, limit=None):
-        objects = []
-        for k, obj in self._items.get(self.collection, {}).items():
-            if self._check_query(obj, query):
-                objects.append(obj)
-        objects = sorted(
-            objects,
-            key=lambda x: [x[k] for k, direction in sort]
-        )
+    def find(self, query: dict, sort: List[Tuple], skip=None, limit=None,
+             batch_size=None, fields: List[str]=None):
+        sort = sort or []
+        stop = None
+        if limit is not None:
+            stop = (skip or 0) + limit
+        ids, ordered = self._plan(query, sort, stop)
+        objects = (obj for doc_id, obj in self._iter_ids(ids, query))
+        if ordered or not sort:
+            if stop is not None:
+                objects = itertools.islice(objects, stop)
+            objects = list(objects)
+        else:
+            objects = self._sort(objects, sort, stop)
         if skip is not None:
             objects = objects[skip:]
         if limit is not None:
             objects = objects[:limit]
+        # callers get copies, changes of them would bypass indexes and journal
+        return [copy.deepcopy(project(obj, fields)) for obj in objects]
+
+    @staticmethod
+    def _sort(objects, sort: List[Tuple], top=None):
+        '''
+        Returns list of objects sorted by `sort` keys. If top is set, only
+        first `top` objects are selected with a heap
+        '''
+        descending = set(direction < 0 for key, direction in sort)
+        if top is not None and len(descending) == 1:
+            keys = [key for key, direction in sort]
+            sort_key = lambda x: tuple(x[key] for key in keys)
+            # both are equivalent to sorted(...)[:top], so stable
+            if descending.pop():
+                return heapq.nlargest(top, objects, key=sort_key)
+            return heapq.nsmallest(top, objects, key=sort_key)
+        objects = list(objects)
+        # stable sort by each key starting from the least significant one
+        for key, direction in reversed(sort):
+            objects.sort(key=lambda x: x[key], reverse=direction < 0)
         return objects
 
     def find_and_modify(self, query, update, sort=None):
@@ -111,29 +1126,336 @@ class MemoryStorage(Storage):
             return False
         return self.update({'id': documents[0]['id']}, update)
 
+    def claim(self, query: dict, new_values: dict, sort: List[Tuple],
+              limit: int, increment: dict=None):
+        new_values = dict(new_values, claim_id=uuid.uuid4().hex)
+        documents = self.find(query, sort, limit=limit)
+        return [self.update({'id': document['id']},
+                            increment_values(document, new_values, increment))
+                for document in documents]
+
+    def count(self, query: dict):
+        query = query or {}
+        items = self._items.get(self.collection, {})
+        if not query:
+            return len(items)
+        if len(query) == 1:
+            k, query_value = list(query.items())[0]
+            index = self._indexes.get(self.collection, {}).get(k)
+            if index is not None:
+                cnt = index.count(query_value)
+                if cnt is not None:
+                    return cnt
+        return sum(1 for _ in self._iter_matched(query))
+
     def save(self, model: Model):
         if not model.id:
             model.id = str(uuid.uuid4())
+        self.save_document(model.id, model.save_data())
+
+    def save_document(self, doc_id, document: dict):
         classname = self.collection
         if classname not in self._items:
-            self._items[classname] = {}
-        self._items[classname][model.id] = model.save_data()
+            # insertion order is used by eviction of capped collections
+            self._items[classname] = collections.OrderedDict()
+        self._remove_from_indexes(doc_id)
+        # caller keeps nested values of the document
+        document = copy.deepcopy(document)
+        self._items[classname][doc_id] = document
+        self._add_to_indexes(doc_id, document)
+        self._log('save', doc_id, document)
+        if self.max_documents is not None:
+            # like capped collection, the oldest inserted documents go first
+            items = self._items[classname]
+            while len(items) > self.max_documents:
+                self.delete_document(next(iter(items)))
+        if self._sweep_due():
+            self.sweep()
+
+    def save_documents(self, documents: List[Tuple]):
+        '''
+        Args:
+            documents: list of (id, document) pairs
+        '''
+        for doc_id, document in documents:
+            self.save_document(doc_id, document)
+
+    def bulk_save(self, models: List[Model]):
+        for model in models:
+            if not model.id:
+                model.id = str(uuid.uuid4())
+        self.save_documents([(m.id, m.save_data()) for m in models])
+
+    def sweep(self):
+        '''
+        Removes documents expired by TTL indexes
+        '''
+        indexes = self._indexes.get(self.collection, {})
+        for field, ttl in self.expiration:
+            query = {field: {'$lt': self._get_expiration_time(ttl)}}
+            index = indexes.get(field)
+            ids = None
+            if isinstance(index, SortedIndex):
+                ids, _ = index.select(query[field])
+            expired = [doc_id for doc_id, _ in self._iter_ids(ids, query)]
+            for doc_id in expired:
+                self.delete_document(doc_id)
 
     def update(self, query: dict, new_values: dict):
-        for k, obj in self._items.get(self.collection, {}).items():
-            if self._check_query(obj, query):
-                for k, v in new_values.items():
-                    if k == '$set':
-                        return self.update(query, v)
-                    path = k.split('.')
-                    if dict_set(obj, v, path):
-                        return obj
+        if '$set' in new_values:
+            return self.update(query, new_values['$set'])
+        for doc_id, obj in self._iter_matched(query):
+            self._remove_from_indexes(doc_id)
+            for k, v in new_values.items():
+                dict_set(obj, v, k.split('.'))
+            self._add_to_indexes(doc_id, obj)
+            self._log('save', doc_id, obj)
+            return copy.deepcopy(obj)
 
     def delete(self, model: Model):
+        self.delete_document(model.id)
+
+    def delete_document(self, doc_id):
         classname = self.collection
-        del self._items[classname][model.id]
+        del self._items[classname][doc_id]
+        self._remove_from_indexes(doc_id)
         if not self._items[classname]:
             del self._items[classname]
+        self._log('delete', doc_id)
+
+    def delete_documents(self, ids: list):
+        items = self._items.get(self.collection, {})
+        for doc_id in ids:
+            if doc_id in items:
+                self.delete_document(doc_id)
+
+    def bulk_delete(self, models: List[Model]):
+        self.delete_documents([model.id for model in models])
+
+
+MemoryStorage.operators = {
+    '$exists': lambda entry, query_value: (entry is not None) == query_value,
+    '$ne': operator.ne,
+    '$in': MemoryStorage._check_in,
+    '$gt': MemoryStorage._compare(operator.gt),
+    '$gte': MemoryStorage._compare(operator.ge),
+    '$lt': MemoryStorage._compare(operator.lt),
+    '$lte': MemoryStorage._compare(operator.le),
+}
+
+
+class _LockedMemoryStorage:
+    '''
+    Server side of SharedMemoryStorage. Manager serves every client
+    connection in its own thread, so all calls are serialized with one lock
+    (find_and_modify must stay atomic for the dealer)
+    '''
+
+    exposed = ('get', 'find', 'find_and_modify', 'claim', 'count', 'update',
+               'bulk_update', 'save_document', 'save_documents',
+               'delete_document', 'delete_documents', 'create_index')
+    lock = threading.Lock()
+    # set by serve_shared_memory_storage()
+    config = {}
+
+    def __init__(self, collection, indexes, max_documents=None):
+        with self.lock:
+            self._storage = MemoryStorage(self.config, collection=collection,
+                                          indexes=indexes,
+                                          max_documents=max_documents)
+
+    def __getattr__(self, name):
+        if name not in self.exposed:
+            raise AttributeError(name)
+        method = getattr(self._storage, name)
+
+        @functools.wraps(method)
+        def locked(*args, **kwargs):
+            with self.lock:
+                return method(*args, **kwargs)
+        return locked
+
+
+class MemoryStorageManager(BaseManager):
+    pass
+
+
+MemoryStorageManager.register('get_storage', callable=_LockedMemoryStorage,
+                              exposed=_LockedMemoryStorage.exposed)
+
+
+def get_authkey(config: dict) -> bytes:
+    '''
+    Manager unpickles requests of clients, so the authkey must be a secret
+    '''
+    authkey = config.get('authkey')
+    if not authkey:
+        raise Exception('authkey is required for SharedMemoryStorage')
+    return authkey.encode()
+
+
+def serve_shared_memory_storage(config: dict):
+    '''
+    Runs server process of SharedMemoryStorage (blocks forever)
+    '''
+    manager = MemoryStorageManager(address=config['address'],
+                                   authkey=get_authkey(config))
+    if os.path.exists(config['address']):
+        os.unlink(config['address'])
+    _LockedMemoryStorage.config = config
+    # daemons run with umask 0, the socket is accessible by the owner only
+    umask = os.umask(0o077)
+    try:
+        server = manager.get_server()
+    finally:
+        os.umask(umask)
+    os.chmod(config['address'], 0o600)
+    server.serve_forever()
+
+
+class SharedMemoryStorage(Storage):
+    '''
+    MemoryStorage shared by all processes of the bot (web, dealer, gunicorn
+    workers). Documents live in one server process (see
+    serve_shared_memory_storage()), other processes call it via unix socket.
+
+    Config:
+        address: path to unix socket
+        authkey: shared secret (required)
+        connect_timeout: seconds to wait for the server (default 5)
+        journal_dir, snapshot_interval, journal_fsync: used by the server,
+            see MemoryStorage
+    '''
+
+    def __init__(self, config: dict, **kwargs):
+        super().__init__(config, **kwargs)
+        manager = self._connect()
+        self._storage = manager.get_storage(self.collection, self.indexes,
+                                            self.max_documents)
+
+    def _connect(self) -> MemoryStorageManager:
+        manager = MemoryStorageManager(address=self.config['address'],
+                                       authkey=get_authkey(self.config))
+        # server may be starting at the same time (see robot.py)
+        deadline = time.time() + self.config.get('connect_timeout', 5)
+        while True:
+            try:
+                manager.connect()
+                return manager
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def create_index(self, spec):
+        self._storage.create_index(spec)
+
+    def get(self, query: dict, fields: List[str]=None):
+        return self._storage.get(query, fields)
+
+    def find(self, query: dict, sort: List[Tuple], skip=None, limit=None,
+             batch_size=None, fields: List[str]=None):
+        return self._storage.find(query, sort, skip, limit, batch_size,
+                                  fields)
+
+    def find_and_modify(self, query, update, sort=None):
+        return self._storage.find_and_modify(query, update, sort)
+
+    def claim(self, query: dict, new_values: dict, sort: List[Tuple],
+              limit: int, increment: dict=None):
+        return self._storage.claim(query, new_values, sort, limit, increment)
+
+    def count(self, query: dict):
+        return self._storage.count(query)
+
+    def save(self, model: Model):
+        if not model.id:
+            model.id = str(uuid.uuid4())
+        self._storage.save_document(model.id, model.save_data())
+
+    def update(self, query: dict, new_values: dict):
+        return self._storage.update(query, new_values)
+
+    def delete(self, model: Model):
+        self._storage.delete_document(model.id)
+
+    def bulk_save(self, models: List[Model]):
+        for model in models:
+            if not model.id:
+                model.id = str(uuid.uuid4())
+        self._storage.save_documents([(m.id, m.save_data()) for m in models])
+
+    def bulk_update(self, updates: List[Tuple[dict, dict]]):
+        return self._storage.bulk_update(updates)
+
+    def bulk_delete(self, models: List[Model]):
+        self._storage.delete_documents([model.id for model in models])
+
+
+class MongoConnectionRegistry:
+    '''
+    Keeps one pooled MongoClient per database uri for the current process
+    and caches collection handles. pymongo clients are not fork-safe, so
+    the registry starts from scratch in a child process (see utils.daemon)
+    '''
+
+    client_options = {
+        'pool_size': 'maxPoolSize',
+        'wait_queue_timeout_ms': 'waitQueueTimeoutMS',
+        'connect_timeout_ms': 'connectTimeoutMS',
+        'socket_timeout_ms': 'socketTimeoutMS',
+        'server_selection_timeout_ms': 'serverSelectionTimeoutMS',
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._clients = {}
+        self._collections = {}
+
+    @staticmethod
+    def get_uri(config: dict):
+        return 'mongodb://{0}:{1}/{2}'.format(
+            config.get('host', 'localhost'),
+            config.get('port', 27017),
+            config['db']
+        )
+
+    def _check_pid(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._clients = {}
+            self._collections = {}
+            self._pid = pid
+
+    def get_client(self, config: dict) -> MongoClient:
+        uri = self.get_uri(config)
+        with self._lock:
+            self._check_pid()
+            client = self._clients.get(uri)
+            if client is None:
+                kwargs = {}
+                for name, option in self.client_options.items():
+                    if config.get(name) is not None:
+                        kwargs[option] = config[name]
+                client = MongoClient(uri, connect=False, **kwargs)
+                self._clients[uri] = client
+            return client
+
+    def get_collection(self, config: dict, name: str) -> Collection:
+        key = (self.get_uri(config), name)
+        with self._lock:
+            self._check_pid()
+            collection = self._collections.get(key)
+        if collection is None:
+            client = self.get_client(config)
+            collection = client.get_default_database()[name]
+            with self._lock:
+                self._collections[key] = collection
+        return collection
+
+
+mongo_connections = MongoConnectionRegistry()
 
 
 class MongoStorage(Storage):
@@ -142,15 +1464,47 @@ class MongoStorage(Storage):
         super().__init__(config, **kwargs)
 
     def __get_collection(self) -> Collection:
-        if not hasattr(self, '__collection'):
-            uri = 'mongodb://{0}:{1}/{2}'.format(
-                self.config.get('host', 'localhost'),
-                self.config.get('port', 27017),
-                self.config['db']
-            )
-            client = MongoClient(uri)
-            self.__collection = client.get_default_database()[self.collection]
-        return self.__collection
+        return mongo_connections.get_collection(self.config, self.collection)
+
+    def create_index(self, spec):
+        index = Index.from_spec(spec)
+        keys = []
+        for key in index.keys:
+            field, direction = (key, 1) if isinstance(key, str) else key
+            keys.append(('_id' if field == 'id' else field, direction))
+        if keys == [('_id', 1)]:
+            return
+        kwargs = {'background': True}
+        if index.ttl is not None:
+            kwargs['expireAfterSeconds'] = index.ttl
+        if index.partial is not None:
+            kwargs['partialFilterExpression'] = \
+                self.__prepare_query(index.partial)
+        self.__get_collection().create_index(keys, **kwargs)
+
+    def ensure_indexes(self):
+        if self.max_documents is not None:
+            self.__ensure_capped()
+        super().ensure_indexes()
+
+    def __ensure_capped(self):
+        collection = self.__get_collection()
+        size = self.max_size or self.max_documents * 4096
+        db = collection.database
+        if self.collection not in db.collection_names():
+            try:
+                db.create_collection(self.collection, capped=True, size=size,
+                                     max=self.max_documents)
+                return
+            except (CollectionInvalid, OperationFailure):
+                # created by another process (or by insert) meanwhile
+                pass
+        if not collection.options().get('capped'):
+            # convertToCapped locks the database while copying documents,
+            # so existing collection is converted by migration
+            logging.getLogger('storage').warning(
+                'Collection {0} is not capped, convert it with '
+                'convertToCapped (size {1})'.format(self.collection, size))
 
     def __prepare_query(self, query: dict):
         if not query:
@@ -163,23 +1517,34 @@ class MongoStorage(Storage):
                 valid_query[k] = v
         return valid_query
 
-    def get(self, query: dict):
+    @staticmethod
+    def __get_projection(fields: List[str]=None):
+        if fields is not None:
+            return {field: True for field in fields}
+
+    def get(self, query: dict, fields: List[str]=None):
         collection = self.__get_collection()
-        document = collection.find_one(self.__prepare_query(query))
+        document = collection.find_one(self.__prepare_query(query),
+                                       self.__get_projection(fields))
         if document:
             document['id'] = document['_id']
             del document['_id']
             return document
 
-    def find(self, query: dict, sort: List[Tuple], skip=None, limit=None):
+    def find(self, query: dict, sort: List[Tuple], skip=None, limit=None,
+             batch_size=None, fields: List[str]=None):
         collection = self.__get_collection()
         kwargs = {}
+        if fields is not None:
+            kwargs['projection'] = self.__get_projection(fields)
         if sort is not None:
             kwargs['sort'] = sort
         if skip is not None:
             kwargs['skip'] = skip
         if limit is not None:
             kwargs['limit'] = limit
+        if batch_size is not None:
+            kwargs['batch_size'] = batch_size
         cursor = collection.find(self.__prepare_query(query), **kwargs)
         for document in cursor:
             document['id'] = document['_id']
@@ -189,28 +1554,392 @@ class MongoStorage(Storage):
     def find_and_modify(self, query, update, sort=None):
         collection = self.__get_collection()
         document = collection.find_one_and_update(
-            query, update, sort=sort, return_document=ReturnDocument.AFTER)
+            self.__prepare_query(query), update, sort=sort,
+            return_document=ReturnDocument.AFTER)
+        if not document:
+            return
+        document['id'] = document['_id']
+        del document['_id']
         return document
 
-    def save(self, model: Model):
+    def claim(self, query: dict, new_values: dict, sort: List[Tuple],
+              limit: int, increment: dict=None):
+        collection = self.__get_collection()
+        query = self.__prepare_query(query)
+        new_values = dict(new_values, claim_id=uuid.uuid4().hex)
+        update = {'$set': new_values}
+        if increment:
+            update['$inc'] = increment
+        documents = list(collection.find(query, sort=sort, limit=limit))
+        if not documents:
+            return []
+        ids = [document['_id'] for document in documents]
+        result = collection.update_many(dict(query, _id={'$in': ids}), update)
+        if result.modified_count == len(ids):
+            for document in documents:
+                values = increment_values(document, new_values, increment)
+                for k, v in values.items():
+                    dict_set(document, v, k.split('.'))
+        else:
+            # some of documents were claimed by another process meanwhile
+            documents = list(collection.find(
+                {'claim_id': new_values['claim_id']}, sort=sort))
+        for document in documents:
+            document['id'] = document.pop('_id')
+        return documents
+
+    def count(self, query: dict):
+        collection = self.__get_collection()
+        query = self.__prepare_query(query)
+        if hasattr(collection, 'count_documents'):
+            return collection.count_documents(query)
+        return collection.count(query)
+
+    @staticmethod
+    def __get_save_data(model: Model):
         data = model.save_data()
         if 'id' in data and data['id']:
             data['_id'] = data['id']
             del data['id']
         if '_id' in data and not data['_id']:
             del(data['_id'])
+        return data
+
+    def save(self, model: Model):
+        data = self.__get_save_data(model)
         collection = self.__get_collection()
-        return collection.save(data)
+        document_id = collection.save(data)
+        if not getattr(model, 'id', None):
+            model.id = document_id
+        return document_id
+
+    def bulk_save(self, models: List[Model]):
+        if not models:
+            return
+        requests = []
+        inserted = []
+        for model in models:
+            data = self.__get_save_data(model)
+            if '_id' in data:
+                requests.append(
+                    ReplaceOne({'_id': data['_id']}, data, upsert=True))
+            else:
+                requests.append(InsertOne(data))
+                inserted.append((model, data))
+        self.__get_collection().bulk_write(requests, ordered=False)
+        # driver sets _id of inserted documents
+        for model, data in inserted:
+            model.id = data['_id']
+
+    def bulk_update(self, updates: List[Tuple[dict, dict]]):
+        if not updates:
+            return 0
+        requests = [
+            UpdateOne(self.__prepare_query(query), {'$set': new_values})
+            for query, new_values in updates
+        ]
+        result = self.__get_collection().bulk_write(requests, ordered=False)
+        return result.matched_count
+
+    def bulk_delete(self, models: List[Model]):
+        if not models:
+            return
+        ids = [model.id for model in models]
+        self.__get_collection().delete_many({'_id': {'$in': ids}})
 
     def update(self, query: dict, new_values: dict):
+        # the document isn't sent back, Model.update uses find_and_modify
         collection = self.__get_collection()
-        document = collection.find_and_modify(
-            self.__prepare_query(query), {'$set': new_values}
-        )
-        document['id'] = document['_id']
-        del document['_id']
-        return document
+        result = collection.update_one(self.__prepare_query(query),
+                                       {'$set': new_values})
+        return result.matched_count
 
     def delete(self, model: Model):
         collection = self.__get_collection()
         collection.remove({'_id': model.id})
+
+
+class SqliteStorage(Storage):
+    '''
+    Storage for single-node deployments. Each collection is a table with
+    documents stored as JSON; queries are translated to SQL with JSON1
+    functions. The database works in WAL mode, so web and dealer processes
+    can use one file concurrently.
+
+    Config:
+        path: path to database file
+        timeout: seconds to wait for a lock (default 30)
+        sweep_interval: see MemoryStorage
+    '''
+
+    key_regexp = re.compile(r'^[A-Za-z0-9_]+(\.[A-Za-z0-9_]+)*$')
+    _local = threading.local()
+
+    def __init__(self, config: dict, **kwargs):
+        super().__init__(config, **kwargs)
+        self.path = config['path']
+        self.timeout = config.get('timeout', 30)
+        self.table = '"{0}"'.format(self.collection)
+        self._get_connection().execute(
+            'CREATE TABLE IF NOT EXISTS {0} '
+            '(id PRIMARY KEY, data TEXT NOT NULL)'.format(self.table)
+        )
+        self.ensure_indexes()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared by threads and processes
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.connections = {}
+        connection = local.connections.get(self.path)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            local.connections[self.path] = connection
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = self._get_connection()
+        # take write lock at once, so concurrent claims are serialized
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+
+    def create_index(self, spec):
+        # partial indexes contain all documents (filter would have to be
+        # rendered with literal values)
+        index = Index.from_spec(spec)
+        if index.fields == ['id']:
+            return
+        name = '"{0}_{1}"'.format(self.collection, index.name)
+        columns = ', '.join(self._get_field(f) for f in index.fields)
+        self._get_connection().execute(
+            'CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})'.format(
+                name, self.table, columns)
+        )
+
+    def _dumps(self, document: dict):
+        return json.dumps(json_encode(document), ensure_ascii=False)
+
+    def _load(self, row):
+        document = json_decode(json.loads(row[1]))
+        document['id'] = row[0]
+        return document
+
+    def _get_field(self, key: str):
+        if key == 'id':
+            return 'id'
+        if not self.key_regexp.match(key):
+            raise Exception('Invalid field name {0}'.format(key))
+        # literal path, so SQLite can use expression indexes
+        return "json_extract(data, '$.{0}')".format(key)
+
+    def _get_condition(self, key, operator, value):
+        field = self._get_field(key)
+        if operator == '$exists':
+            return '{0} IS {1}NULL'.format(field, 'NOT ' if value else ''), []
+        if operator == '$ne':
+            if value is None:
+                return '{0} IS NOT NULL'.format(field), []
+            return '({0} IS NULL OR {0} != ?)'.format(field), \
+                [json_encode(value)]
+        if operator == '$in':
+            values = [json_encode(v) for v in value if v is not None]
+            clauses = []
+            if values:
+                clauses.append('{0} IN ({1})'.format(
+                    field, ', '.join('?' * len(values))))
+            if None in value:
+                clauses.append('{0} IS NULL'.format(field))
+            return '({0})'.format(' OR '.join(clauses) or '0'), values
+        sql_operators = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+        if operator in sql_operators:
+            return '{0} {1} ?'.format(field, sql_operators[operator]), \
+                [json_encode(value)]
+        raise Exception('Unsupported operator {0}'.format(operator))
+
+    def _get_where(self, query: dict, prefix=''):
+        clauses = []
+        params = []
+        for k, query_value in (query or {}).items():
+            key = prefix + k
+            if isinstance(query_value, dict):
+                if all(name.startswith('$') for name in query_value):
+                    for operator, value in query_value.items():
+                        clause, values = self._get_condition(key, operator,
+                                                             value)
+                        clauses.append(clause)
+                        params.extend(values)
+                    continue
+                clause, values = self._get_where(query_value, key + '.')
+            elif query_value is None:
+                clause, values = '{0} IS NULL'.format(self._get_field(key)), []
+            elif isinstance(query_value, list):
+                clause = '{0} = json(?)'.format(self._get_field(key))
+                values = [json.dumps(json_encode(query_value))]
+            else:
+                clause = '{0} = ?'.format(self._get_field(key))
+                values = [json_encode(query_value)]
+            clauses.append(clause)
+            params.extend(values)
+        return ' AND '.join(clauses) or '1', params
+
+    def _select(self, connection, query: dict, sort: List[Tuple]=None,
+                skip=None, limit=None):
+        where, params = self._get_where(query)
+        sql = 'SELECT id, data FROM {0} WHERE {1}'.format(self.table, where)
+        if sort:
+            sql += ' ORDER BY ' + ', '.join(
+                '{0} {1}'.format(self._get_field(key),
+                                 'DESC' if direction < 0 else 'ASC')
+                for key, direction in sort
+            )
+        if limit is not None or skip is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            params += [limit if limit is not None else -1, skip or 0]
+        return connection.execute(sql, params)
+
+    def _apply_update(self, connection, document: dict, new_values: dict):
+        if '$set' in new_values:
+            new_values = new_values['$set']
+        for k, v in new_values.items():
+            dict_set(document, v, k.split('.'))
+        connection.execute(
+            'UPDATE {0} SET data = ? WHERE id = ?'.format(self.table),
+            (self._dumps(document), document['id'])
+        )
+        return document
+
+    def get(self, query: dict, fields: List[str]=None):
+        row = self._select(self._get_connection(), query, limit=1).fetchone()
+        if row is not None:
+            return project(self._load(row), fields)
+
+    def find(self, query: dict, sort: List[Tuple], skip=None, limit=None,
+             batch_size=None, fields: List[str]=None):
+        cursor = self._select(self._get_connection(), query, sort, skip,
+                              limit)
+        if batch_size is not None:
+            cursor.arraysize = batch_size
+        return [project(self._load(row), fields) for row in cursor]
+
+    def find_and_modify(self, query, update, sort=None):
+        with self._transaction() as connection:
+            row = self._select(connection, query, sort, limit=1).fetchone()
+            if row is None:
+                return
+            return self._apply_update(connection, self._load(row), update)
+
+    def claim(self, query: dict, new_values: dict, sort: List[Tuple],
+              limit: int, increment: dict=None):
+        new_values = dict(new_values, claim_id=uuid.uuid4().hex)
+        with self._transaction() as connection:
+            rows = self._select(connection, query, sort, limit=limit)
+            documents = []
+            for row in rows.fetchall():
+                document = self._load(row)
+                values = increment_values(document, new_values, increment)
+                documents.append(
+                    self._apply_update(connection, document, values))
+            return documents
+
+    def count(self, query: dict):
+        where, params = self._get_where(query)
+        sql = 'SELECT COUNT(*) FROM {0} WHERE {1}'.format(self.table, where)
+        return self._get_connection().execute(sql, params).fetchone()[0]
+
+    def save(self, model: Model):
+        if not getattr(model, 'id', None):
+            model.id = str(uuid.uuid4())
+        with self._transaction() as connection:
+            self._save_rows(connection,
+                            [(model.id, self._dumps(model.save_data()))])
+        if self._sweep_due():
+            self.sweep()
+
+    def _save_rows(self, connection, rows: List[Tuple]):
+        '''
+        Saves (id, data) rows. Unlike INSERT OR REPLACE, existing rows keep
+        rowid, so sweep removes the oldest inserted rows
+        '''
+        connection.executemany(
+            'UPDATE {0} SET data = ? WHERE id = ?'.format(self.table),
+            [(data, doc_id) for doc_id, data in rows]
+        )
+        connection.executemany(
+            'INSERT OR IGNORE INTO {0} (id, data) VALUES (?, ?)'.format(
+                self.table),
+            rows
+        )
+
+    def sweep(self):
+        '''
+        Removes documents expired by TTL indexes and the oldest inserted
+        documents above max_documents
+        '''
+        with self._transaction() as connection:
+            for field, ttl in self.expiration:
+                expiration_time = self._get_expiration_time(ttl)
+                connection.execute(
+                    'DELETE FROM {0} WHERE {1} < ?'.format(
+                        self.table, self._get_field(field)),
+                    (json_encode(expiration_time),)
+                )
+            if self.max_documents is not None:
+                connection.execute(
+                    'DELETE FROM {0} WHERE rowid NOT IN (SELECT rowid '
+                    'FROM {0} ORDER BY rowid DESC LIMIT ?)'.format(
+                        self.table),
+                    (self.max_documents,)
+                )
+
+    def update(self, query: dict, new_values: dict):
+        with self._transaction() as connection:
+            row = self._select(connection, query, limit=1).fetchone()
+            if row is None:
+                return
+            return self._apply_update(connection, self._load(row),
+                                      new_values)
+
+    def delete(self, model: Model):
+        self._get_connection().execute(
+            'DELETE FROM {0} WHERE id = ?'.format(self.table), (model.id,)
+        )
+
+    def bulk_save(self, models: List[Model]):
+        for model in models:
+            if not getattr(model, 'id', None):
+                model.id = str(uuid.uuid4())
+        with self._transaction() as connection:
+            self._save_rows(connection,
+                            [(m.id, self._dumps(m.save_data()))
+                             for m in models])
+        if self._sweep_due():
+            self.sweep()
+
+    def bulk_update(self, updates: List[Tuple[dict, dict]]):
+        count = 0
+        with self._transaction() as connection:
+            for query, new_values in updates:
+                row = self._select(connection, query, limit=1).fetchone()
+                if row is not None:
+                    self._apply_update(connection, self._load(row),
+                                       new_values)
+                    count += 1
+        return count
+
+    def bulk_delete(self, models: List[Model]):
+        with self._transaction() as connection:
+            connection.executemany(
+                'DELETE FROM {0} WHERE id = ?'.format(self.table),
+                [(model.id,) for model in models]
+            )
@@ -0,0 +1,32 @@
+import asyncio
+import datetime
+
+import pytest
+
+from bot.activity import UserActivityBuffer
+from bot.model import User
+
+
+@pytest.mark.async_test
+async def test_flush_user_activity(user):
+    buffer = UserActivityBuffer(flush_interval=60, max_size=100)
+    first_time = datetime.datetime(2016, 9, 1, 12, 30, 1)
+    last_time = datetime.datetime(2016, 9, 1, 12, 30, 5)
+    buffer.touch(user.id, last_time)
+    buffer.touch(user.id, first_time)
+    assert len(buffer) == 1
+    assert User.get({'id': user.id}).last_request_time != last_time
+
+    await buffer.flush()
+    assert len(buffer) == 0
+    assert User.get({'id': user.id}).last_request_time == last_time
+
+
+@pytest.mark.async_test
+async def test_flush_user_activity_by_size(user):
+    buffer = UserActivityBuffer(flush_interval=60, max_size=1)
+    now = datetime.datetime.now()
+    buffer.touch(user.id, now)
+    await asyncio.sleep(0.01)
+    assert len(buffer) == 0
+    assert User.get({'id': user.id}).last_request_time == now
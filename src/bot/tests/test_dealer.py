@@ -2,10 +2,12 @@ import asyncio
 import string
 import datetime
 import random
+import types
 
 import pytest
 
 from bot.dealer import EvernoteDealer
+from bot.model import FailedUpdate
 from bot.model import TelegramUpdate
 from bot.model import User
 from bot.message_handlers import TextHandler
@@ -34,7 +36,8 @@ def user():
     return user
 
 
-def test_fetch_updates():
+@pytest.mark.async_test
+async def test_fetch_updates():
     TelegramUpdate.create(user_id=1,
                           request_type='text',
                           status_message_id=2,
@@ -51,7 +54,7 @@ def test_fetch_updates():
                           message={'data': 'yeah!'},
                           created=datetime.datetime(2016, 9, 1, 12, 30, 2))
     dealer = EvernoteDealer()
-    user_updates = dealer.fetch_updates()
+    user_updates = await dealer.fetch_updates()
     updates = user_updates[1]
     updates2 = user_updates[2]
     assert len(updates) == 2
@@ -86,3 +89,190 @@ async def test_process_user_updates(user):
     await asyncio.sleep(0.1)
     assert handler.evernote.update_note.call_count == 1
     assert handler.telegram.editMessageText.call_count == 1
+
+
+@pytest.mark.async_test
+async def test_dealer_backpressure():
+    TelegramUpdate.bulk_delete(TelegramUpdate.find())
+    user_ids = list(range(1001, 1006))
+    for user_id in user_ids:
+        User.create(id=user_id, telegram_chat_id=user_id)
+        TelegramUpdate.create(user_id=user_id, request_type='text',
+                              status_message_id=1, message={})
+    dealer = EvernoteDealer()
+    dealer.workers = 2
+    dealer.queue_size = 1
+    done = asyncio.Event()
+    processed = []
+
+    async def process_user_updates(user, updates, *args):
+        await done.wait()
+        processed.append(user.id)
+    dealer.process_user_updates = process_user_updates
+
+    task = asyncio.ensure_future(dealer.async_run())
+    await asyncio.sleep(0.1)
+    assert dealer.get_load() == \
+        {'workers': 2, 'in_flight': 2, 'queued': 1, 'lanes': 3, 'leases': 3}
+    not_claimed = {'user_id': {'$in': user_ids},
+                   'in_process': {'$exists': False}}
+    assert TelegramUpdate.count(not_claimed) == 2
+    done.set()
+    await asyncio.sleep(0.1)
+    task.cancel()
+    assert sorted(processed) == user_ids
+    assert dealer.in_flight == 0
+    assert not dealer.lanes
+    assert not dealer.leases
+
+
+@pytest.mark.async_test
+async def test_dealer_user_lanes():
+    def updates(*ids):
+        return [types.SimpleNamespace(id=x) for x in ids]
+
+    dealer = EvernoteDealer()
+    dealer.user_fields = None
+    running = set()
+    processed = []
+    gate = asyncio.Event()
+
+    async def process_user_updates(user, updates, *args):
+        assert user.id not in running
+        running.add(user.id)
+        await gate.wait()
+        processed.append((user.id, updates))
+        running.remove(user.id)
+    dealer.process_user_updates = process_user_updates
+    for user_id in [2001, 2002]:
+        User.create(id=user_id, telegram_chat_id=user_id)
+
+    workers = [asyncio.ensure_future(dealer.worker()) for _ in range(3)]
+    dealer.enqueue(2001, updates(1, 2))
+    dealer.enqueue(2002, updates(1))
+    await asyncio.sleep(0.05)
+    assert running == {2001, 2002}
+    # first list of 2001 is being processed, the next ones wait in its lane
+    dealer.enqueue(2001, updates(3))
+    dealer.enqueue(2001, updates(4))
+    await asyncio.sleep(0.05)
+    assert dealer.get_load()['in_flight'] == 2
+    gate.set()
+    await asyncio.sleep(0.05)
+    for worker in workers:
+        worker.cancel()
+    assert [x for x in processed if x[0] == 2001] == \
+        [(2001, updates(1, 2)), (2001, updates(3, 4))]
+    assert (2002, updates(1)) in processed
+    assert not dealer.lanes
+    assert dealer.pending == 0
+
+
+@pytest.mark.async_test
+async def test_dealer_leases():
+    TelegramUpdate.bulk_delete(TelegramUpdate.find())
+    expired = datetime.datetime.now() - datetime.timedelta(seconds=1)
+    for user_id, attempts in [(3001, 1), (3002, 5)]:
+        TelegramUpdate.create(user_id=user_id, request_type='text',
+                              status_message_id=1, message={})
+        TelegramUpdate.storage.update(
+            {'user_id': user_id},
+            {'in_process': True, 'worker_id': 'dead', 'attempts': attempts,
+             'lease_expires': expired})
+    TelegramUpdate.create(user_id=3003, request_type='text',
+                          status_message_id=1, message={})
+    # claimed by dealer without leases
+    TelegramUpdate.create(user_id=3004, request_type='text',
+                          status_message_id=1, message={})
+    TelegramUpdate.storage.update({'user_id': 3004}, {'in_process': True})
+    dealer = EvernoteDealer()
+    dealer.max_attempts = 5
+
+    updates_by_user = await dealer.fetch_updates()
+    assert sorted(updates_by_user) == [3001, 3003, 3004]
+    assert updates_by_user[3004][0].attempts == 1
+    reclaimed = updates_by_user[3001][0]
+    assert reclaimed.attempts == 2
+    assert reclaimed.worker_id == dealer.worker_id
+    assert reclaimed.lease_expires > datetime.datetime.now()
+    assert updates_by_user[3003][0].attempts == 1
+    assert set(dealer.leases) == \
+        {x[0].id for x in updates_by_user.values()}
+    # the update was claimed too many times
+    assert TelegramUpdate.count({'user_id': 3002}) == 0
+    assert FailedUpdate.count({'user_id': 3002}) == 1
+    # leases are not expired yet
+    dealer._next_reclaim = 0
+    assert await dealer.fetch_updates() == {}
+
+    TelegramUpdate.storage.update({'id': reclaimed.id},
+                                  {'lease_expires': expired})
+    await dealer.renew_leases()
+    assert TelegramUpdate.get({'id': reclaimed.id}).lease_expires > \
+        datetime.datetime.now()
+
+
+@pytest.mark.async_test
+async def test_dealer_release_failed_updates():
+    TelegramUpdate.bulk_delete(TelegramUpdate.find())
+    User.create(id=4001, telegram_chat_id=4001)
+    start = datetime.datetime.now()
+    for i in range(3):
+        TelegramUpdate.create(user_id=4001, request_type='text',
+                              status_message_id=i, message={},
+                              created=start + datetime.timedelta(seconds=i))
+    dealer = EvernoteDealer()
+    gate = asyncio.Event()
+
+    async def process_user_updates(user, updates, processed):
+        await gate.wait()
+        TelegramUpdate.bulk_delete(updates[:1])
+        processed.append(updates[0])
+        raise Exception('Evernote is down')
+    dealer.process_user_updates = process_user_updates
+
+    updates = (await dealer.fetch_updates(limit=2))[4001]
+    worker = asyncio.ensure_future(dealer.worker())
+    dealer.enqueue(4001, updates)
+    await asyncio.sleep(0.01)
+    # the newer update is claimed while the first ones are processed
+    dealer.enqueue(4001, (await dealer.fetch_updates())[4001])
+    gate.set()
+    await asyncio.sleep(0.05)
+    worker.cancel()
+    assert not dealer.leases
+    assert dealer.pending == 0
+
+    # failed update and the rest wait for retry_delay seconds
+    released = TelegramUpdate.find({'user_id': 4001})
+    retry_time = datetime.datetime.now() + \
+        datetime.timedelta(seconds=dealer.retry_delay)
+    for update in released:
+        assert update.worker_id is None
+        assert abs((update.lease_expires - retry_time).total_seconds()) < 1
+    dealer.process_user_updates = None
+    assert await dealer.fetch_updates() == {}
+    # newer update of the user is not processed before failed one
+    TelegramUpdate.create(user_id=4001, request_type='text',
+                          status_message_id=3, message={},
+                          created=start + datetime.timedelta(seconds=3))
+    assert await dealer.fetch_updates() == {}
+    assert not dealer.leases
+
+    # then they are claimed again in order
+    past = datetime.datetime.now() - datetime.timedelta(seconds=1)
+    TelegramUpdate.bulk_update(
+        [({'id': x.id}, {'lease_expires': past})
+         for x in TelegramUpdate.find({'user_id': 4001})])
+    dealer._delayed_users = {}
+    dealer._next_reclaim = 0
+    updates = (await dealer.fetch_updates())[4001]
+    assert [x.status_message_id for x in updates] == [1, 2, 3]
+    assert [x.attempts for x in updates] == [2, 1, 1]
+
+    # the next failure doubles the delay
+    dealer.release = AsyncMock()
+    await dealer.retry_later(updates[:1])
+    retry_time = dealer.release.call_args[0][1]
+    delay = (retry_time - datetime.datetime.now()).total_seconds()
+    assert abs(delay - dealer.retry_delay * 2) < 1
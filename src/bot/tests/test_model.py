@@ -1,4 +1,11 @@
+import logging
+
+import pytest
+
+from bot.model import Index
 from bot.model import Model
+from bot.model import ModelNotFound
+from bot.model import UnitOfWork
 
 
 def test_model():
@@ -25,3 +32,176 @@ def test_model():
 
     t = TestModel.get({'name': 'new'})
     assert t.value == 'val'
+
+
+@pytest.mark.async_test
+async def test_model_async():
+    class AsyncTestModel(Model):
+        save_fields = ['name', 'value']
+
+    t1 = await AsyncTestModel.acreate(name='test', value=1)
+    t = await AsyncTestModel.aget({'id': t1.id})
+    assert t.name == 'test'
+    t.value = 2
+    await t.asave()
+    t = await AsyncTestModel.aget({'id': t1.id})
+    assert t.value == 2
+    assert await AsyncTestModel.acount({'name': 'test'}) == 1
+    entries = await AsyncTestModel.afind({'name': 'test'})
+    assert [e.value for e in entries] == [2]
+    await t.adelete()
+    assert await AsyncTestModel.acount() == 0
+
+
+@pytest.mark.async_test
+async def test_model_lazy_find():
+    class LazyTestModel(Model):
+        save_fields = ['value']
+
+    for i in range(5):
+        LazyTestModel.create(value=i)
+
+    entries = LazyTestModel.find(sort=[('value', 1)], lazy=True)
+    assert not isinstance(entries, list)
+    assert next(entries).value == 0
+    assert [e.value for e in entries] == [1, 2, 3, 4]
+
+    values = []
+    async for entry in LazyTestModel.afind_iter(sort=[('value', -1)],
+                                                batch_size=2):
+        values.append(entry.value)
+    assert values == [4, 3, 2, 1, 0]
+
+
+def test_model_projection():
+    class ProjectionTestModel(Model):
+        save_fields = ['name', 'value', 'data']
+
+        def __init__(self, name, value, data, **kwargs):
+            self.id = kwargs.get('id')
+            self.name = name
+            self.value = value
+            self.data = data
+
+    t1 = ProjectionTestModel.create(name='test', value=1,
+                                    data={'a': 1, 'b': 2})
+    t = ProjectionTestModel.get({'id': t1.id}, fields=['value', 'data.b'])
+    assert t.id == t1.id
+    assert t.value == 1
+    assert t.data == {'b': 2}
+    assert not hasattr(t, 'name')
+
+    t.value = 2
+    t.save()
+    t = ProjectionTestModel.get({'id': t1.id})
+    assert t.name == 'test'
+    assert t.value == 2
+    assert t.data == {'a': 1, 'b': 2}
+
+    entries = ProjectionTestModel.find({'name': 'test'}, fields=['name'])
+    assert [(e.id, e.name) for e in entries] == [(t1.id, 'test')]
+
+
+def test_model_saves_only_changed_fields():
+    class DirtyTestModel(Model):
+        save_fields = ['name', 'data']
+
+    t = DirtyTestModel.create(name='test', data={'a': 1})
+    assert t.get_changes() == {}
+    t = DirtyTestModel.get({'id': t.id})
+    assert t.get_changes() == {}
+    t.name = 'new'
+    t.data['b'] = 2
+    assert t.get_changes() == {'name': 'new', 'data': {'a': 1, 'b': 2}}
+
+    storage = DirtyTestModel.storage
+    calls = []
+    storage_update = storage.update
+    storage.update = lambda query, values: calls.append(values) or \
+        storage_update(query, values)
+    t.save()
+    t.save()
+    del storage.update
+    assert calls == [{'name': 'new', 'data': {'a': 1, 'b': 2}}]
+    t = DirtyTestModel.get({'id': t.id})
+    assert t.name == 'new'
+    assert t.data == {'a': 1, 'b': 2}
+
+    # deleted document is not inserted again
+    DirtyTestModel.storage.delete(t)
+    t.name = 'deleted'
+    with pytest.raises(ModelNotFound):
+        t.save()
+    assert DirtyTestModel.count({'id': t.id}) == 0
+
+
+@pytest.mark.async_test
+async def test_unit_of_work():
+    class UnitOfWorkTestModel(Model):
+        save_fields = ['name']
+
+    t1 = UnitOfWorkTestModel.create(name='test')
+    async with UnitOfWork():
+        t = await UnitOfWorkTestModel.aget({'id': t1.id})
+        assert await UnitOfWorkTestModel.aget({'id': t1.id}) is t
+        assert await UnitOfWorkTestModel.acount({'id': t1.id}) == 1
+        t.name = 'new'
+        await t.asave()
+        assert UnitOfWorkTestModel.get({'id': t1.id}).name == 'test'
+    assert UnitOfWorkTestModel.get({'id': t1.id}).name == 'new'
+    assert await UnitOfWorkTestModel.aget({'id': t1.id}) is not t
+
+
+@pytest.mark.async_test
+async def test_model_cache():
+    class CachedTestModel(Model):
+        use_cache = True
+        save_fields = ['name']
+
+    t1 = CachedTestModel.create(name='test')
+    t = await CachedTestModel.aget({'id': t1.id})
+    CachedTestModel.storage.update({'id': t1.id}, {'name': 'changed'})
+    assert (await CachedTestModel.aget({'id': t1.id})).name == 'test'
+
+    t.name = 'new'
+    await t.asave()
+    assert (await CachedTestModel.aget({'id': t1.id})).name == 'new'
+
+
+def test_unindexed_queries(caplog):
+    class QueryCheckModel(Model):
+        indexes = [
+            'user_id',
+            Index('in_process', ('created', 1)),
+            Index('key', partial={'key': {'$exists': True}}),
+        ]
+
+    caplog.set_level(logging.WARNING, logger='storage')
+    QueryCheckModel.count({'user_id': 1})
+    QueryCheckModel.find({'in_process': {'$exists': False}}, [('created', 1)])
+    QueryCheckModel.count({'id': 1, 'name': 'test'})
+    QueryCheckModel.count({'key': 'a'})
+    assert not caplog.records
+
+    QueryCheckModel.count({'data': {'key': 'a'}})
+    QueryCheckModel.count({'data.key': 'b'})
+    # compound index can't be used without its first field
+    QueryCheckModel.find({}, [('created', 1)])
+    messages = [r.getMessage() for r in caplog.records]
+    assert messages == [
+        "Unindexed query on QueryCheckModel: fields ['data.key'], sort None",
+        "Unindexed query on QueryCheckModel: fields [], sort created",
+    ]
+
+
+@pytest.mark.async_test
+async def test_async_bulk_operations():
+    class AsyncBulkModel(Model):
+        save_fields = ['value']
+
+    models = [AsyncBulkModel(value=i) for i in range(3)]
+    await AsyncBulkModel.abulk_save(models)
+    assert await AsyncBulkModel.acount() == 3
+    assert not models[0].get_changes()
+    await AsyncBulkModel.abulk_delete(models[:2])
+    assert await AsyncBulkModel.acount() == 1
@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+import pytest
+
+from bot.dealer import EvernoteDealer
+from bot.notify import LocalNotifier
+from bot.notify import UnixSocketNotifier
+
+
+@pytest.mark.async_test
+async def test_local_notifier():
+    notifier = LocalNotifier()
+    assert not await notifier.wait(0.01)
+    notifier.notify()
+    notifier.notify()
+    assert await notifier.wait(0.01)
+    assert not await notifier.wait(0.01)
+
+
+@pytest.mark.async_test
+async def test_unix_socket_notifier(tmpdir):
+    config = {'address': str(tmpdir.join('dealer.sock'))}
+    dealer_notifier = UnixSocketNotifier(config)
+    web_notifier = UnixSocketNotifier(config)
+    # nobody listens yet
+    web_notifier.notify()
+    assert not await dealer_notifier.wait(0.01)
+    try:
+        asyncio.get_event_loop().call_later(0.05, web_notifier.notify)
+        start = time.monotonic()
+        assert await dealer_notifier.wait(5)
+        assert time.monotonic() - start < 1
+        assert not await dealer_notifier.wait(0.01)
+    finally:
+        dealer_notifier.close()
+
+
+def test_dealer_poll_interval(monkeypatch):
+    monkeypatch.setattr('bot.dealer.get_notifier', LocalNotifier)
+    # web processes can't wake dealer up
+    dealer = EvernoteDealer()
+    assert dealer.max_poll_interval == dealer.poll_interval
+    monkeypatch.setattr('bot.dealer.get_notifier', lambda: UnixSocketNotifier(
+        {'address': '/tmp/dealer.sock'}))
+    assert EvernoteDealer().max_poll_interval == 1
@@ -59,7 +59,7 @@ async def test_save_photo_multiple_notes_mode(user):
     handler.evernote.update_note = AsyncMock()
     handler.telegram.editMessageText = AsyncMock()
     dealer.handlers['photo'] = [handler]
-    user_updates = dealer.fetch_updates()
+    user_updates = await dealer.fetch_updates()
     await dealer.process_user_updates(user, user_updates[user.id])
     await asyncio.sleep(0.1)
 
@@ -128,7 +128,7 @@ async def test_save_photo_one_note_mode(user):
     handler.evernote.update_note = AsyncMock()
     handler.telegram.editMessageText = AsyncMock()
     dealer.handlers['photo'] = [handler]
-    user_updates = dealer.fetch_updates()
+    user_updates = await dealer.fetch_updates()
     await dealer.process_user_updates(user, user_updates[user.id])
     await asyncio.sleep(0.1)
 
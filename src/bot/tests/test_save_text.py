@@ -46,7 +46,7 @@ async def test_save_text_multiple_notes_mode(user):
     handler.telegram.editMessageText = AsyncMock()
     dealer.handlers['text'] = [handler]
 
-    user_updates = dealer.fetch_updates()
+    user_updates = await dealer.fetch_updates()
     await dealer.process_user_updates(user, user_updates[user.id])
     await asyncio.sleep(0.1)
     assert handler.evernote.create_note.call_count == 1
@@ -58,7 +58,7 @@ async def test_save_voice_multiple_notes_mode(user):
                                        file_id)
     handler.get_files = AsyncMock(return_value=[(downloaded_filename, 'audio/wav')])
     dealer.handlers['voice'] = [handler]
-    user_updates = dealer.fetch_updates()
+    user_updates = await dealer.fetch_updates()
     await dealer.process_user_updates(user, user_updates[user.id])
     await asyncio.sleep(0.1)
 
@@ -0,0 +1,442 @@
+import datetime
+import logging
+import os
+import time
+
+import pytest
+
+from bot.model import Index
+from bot.model import Model
+from bot.storage import HashIndex
+from bot.storage import MemoryJournal
+from bot.storage import MemoryStorage
+from bot.storage import MemoryStorageManager
+from bot.storage import MongoConnectionRegistry
+from bot.storage import SharedMemoryStorage
+from bot.storage import SortedIndex
+from bot.storage import storage_stats
+from bot.storage import SqliteStorage
+
+
+def test_mongo_connection_registry(monkeypatch):
+    registry = MongoConnectionRegistry()
+    config = {'db': 'test', 'pool_size': 10}
+    client = registry.get_client(config)
+    assert registry.get_client(config) is client
+    users = registry.get_collection(config, 'user')
+    assert registry.get_collection(config, 'user') is users
+
+    pid = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: pid + 1)
+    assert registry.get_client(config) is not client
+
+
+def test_memory_storage_indexes():
+    class IndexedModel(Model):
+        save_fields = ['user_id', 'data']
+
+    storage = MemoryStorage({}, collection='indexedmodel',
+                            indexes=['user_id', 'data.key'])
+    IndexedModel.storage = storage
+    m1 = IndexedModel.create(user_id=1, data={'key': 'a'})
+    m2 = IndexedModel.create(user_id=2, data={'key': 'b'})
+    IndexedModel.create(user_id=2, data={'key': 'c'})
+
+    assert storage._get_candidate_ids({'id': m1.id}) == [m1.id]
+    assert len(storage._get_candidate_ids({'user_id': 2})) == 2
+    assert storage._get_candidate_ids({'data.key': 'b'}) == [m2.id]
+    assert storage.get({'data.key': 'b'})['user_id'] == 2
+    assert len(storage.find({'user_id': 2}, [])) == 2
+    assert storage.find({'user_id': 2, 'data.key': 'c'}, [])[0]['data'] == \
+        {'key': 'c'}
+
+    # returned documents are copies
+    storage.get({'id': m2.id})['data']['key'] = 'changed'
+    storage.find({'id': m2.id}, [])[0]['user_id'] = 5
+    assert storage.get({'data.key': 'b'})['user_id'] == 2
+    assert storage.find({'user_id': 5}, []) == []
+
+    storage.update({'id': m2.id}, {'$set': {'user_id': 3}})
+    assert len(storage.find({'user_id': 2}, [])) == 1
+    assert storage.get({'user_id': 3})['id'] == m2.id
+    assert storage._get_candidate_ids({'user_id': {'$exists': False}}) == []
+
+    m1.delete()
+    assert storage.find({'data.key': 'a'}, []) == []
+    assert storage._get_candidate_ids({'user_id': 1}) == []
+
+
+def test_memory_storage_range_queries():
+    class RangeModel(Model):
+        save_fields = ['value', 'tag']
+
+    storage = MemoryStorage({}, collection='rangemodel',
+                            indexes=[('value', 1)])
+    RangeModel.storage = storage
+    for i in [5, 3, 9, 1, 7]:
+        RangeModel.create(value=i, tag='odd')
+    RangeModel.create(value=4, tag='even')
+    RangeModel.create(tag='none')
+
+    def values(query, sort=None, skip=None, limit=None):
+        return [x['value'] for x in storage.find(query, sort, skip, limit)]
+
+    assert values({'value': {'$gte': 3, '$lt': 7}}, [('value', 1)]) == \
+        [3, 4, 5]
+    assert values({'value': {'$gt': 3}}, [('value', -1)], limit=2) == [9, 7]
+    assert values({}, [('value', 1)], skip=1, limit=3) == [1, 3, 4]
+    assert values({'value': {'$in': [1, 9, 10]}}, [('value', 1)]) == [1, 9]
+    assert values({'tag': {'$ne': 'odd'}, 'value': {'$lte': 4}}) == [4]
+    assert len(storage._get_candidate_ids({'value': {'$lte': 4}})) == 3
+    assert storage.get({'value': {'$exists': False}})['tag'] == 'none'
+    assert values({'tag': 'odd'}, [('tag', 1), ('value', -1)]) == \
+        [9, 7, 5, 3, 1]
+
+
+def test_memory_storage_count():
+    class CountModel(Model):
+        save_fields = ['value', 'tag']
+
+    storage = MemoryStorage({}, collection='countmodel',
+                            indexes=['tag', ('value', 1)])
+    CountModel.storage = storage
+    for i in range(10):
+        CountModel.create(value=i, tag='even' if i % 2 == 0 else 'odd')
+    CountModel.create(tag='none')
+
+    assert CountModel.count() == 11
+    assert CountModel.count({'tag': 'odd'}) == 5
+    assert CountModel.count({'value': {'$gte': 3, '$lt': 7}}) == 4
+    assert CountModel.count({'value': {'$exists': False}}) == 1
+    assert CountModel.count({'tag': 'even', 'value': {'$gt': 4}}) == 2
+    assert CountModel.count({'tag': 'unknown'}) == 0
+
+
+def test_sqlite_storage(tmpdir):
+    class SqliteModel(Model):
+        save_fields = ['user_id', 'created', 'data']
+
+    config = {'path': str(tmpdir.join('test.sqlite'))}
+    storage = SqliteStorage(config, collection='sqlitemodel',
+                            indexes=['data.key', ('created', 1)])
+    SqliteModel.storage = storage
+    start = datetime.datetime(2016, 9, 1, 12, 30)
+    for i in range(5):
+        SqliteModel.create(user_id=i % 2, data={'key': str(i)},
+                           created=start + datetime.timedelta(seconds=i))
+
+    m = SqliteModel.get({'data.key': '3'})
+    assert m.user_id == 1
+    assert m.created == start + datetime.timedelta(seconds=3)
+    assert SqliteModel.get({'id': m.id}).data == {'key': '3'}
+    assert SqliteModel.count() == 5
+    assert SqliteModel.count({'user_id': 1}) == 2
+    assert SqliteModel.count({'data': {'key': {'$in': ['1', '2']}}}) == 2
+    query = {'created': {'$gte': start + datetime.timedelta(seconds=2)}}
+    assert [x.data['key'] for x in SqliteModel.find(
+        query, sort=[('created', -1)], skip=1, limit=2)] == ['3', '2']
+    assert SqliteModel.get({'id': m.id}, fields=['data.key']).data == \
+        {'key': '3'}
+
+    query = {'in_process': {'$exists': False}}
+    update = {'$set': {'in_process': True}}
+    claimed = storage.find_and_modify(query, update, [('created', 1)])
+    assert claimed['data']['key'] == '0'
+    assert claimed['in_process'] is True
+    assert storage.count(query) == 4
+
+    m.user_id = 5
+    m.save()
+    assert SqliteModel.get({'id': m.id}).user_id == 5
+    m.delete()
+    assert SqliteModel.count() == 4
+
+    plan = storage._get_connection().execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM sqlitemodel "
+        "WHERE json_extract(data, '$.data.key') = '1'").fetchall()
+    assert 'sqlitemodel_data__key' in str(plan)
+
+    storage.create_index(Index('user_id', ('created', -1)))
+    plan = storage._get_connection().execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM sqlitemodel "
+        "WHERE json_extract(data, '$.user_id') = 1 "
+        "ORDER BY json_extract(data, '$.created')").fetchall()
+    assert 'sqlitemodel_user_id__created' in str(plan)
+
+
+def test_shared_memory_storage(tmpdir):
+    class SharedModel(Model):
+        save_fields = ['user_id', 'in_process']
+
+    config = {'address': str(tmpdir.join('storage.sock')), 'authkey': 'test'}
+    manager = MemoryStorageManager(address=config['address'],
+                                   authkey=b'test')
+    manager.start()
+    try:
+        # two storages have separate connections like two processes
+        storage1 = SharedMemoryStorage(config, collection='sharedmodel',
+                                       indexes=['user_id'])
+        storage2 = SharedMemoryStorage(config, collection='sharedmodel')
+        SharedModel.storage = storage1
+        for i in range(3):
+            SharedModel.create(user_id=i)
+        SharedModel.storage = storage2
+        assert SharedModel.count() == 3
+        m = SharedModel.get({'user_id': 1})
+        m.in_process = True
+        m.save()
+        assert storage1.get({'id': m.id})['in_process'] is True
+
+        update = {'$set': {'in_process': True}}
+        query = {'in_process': {'$exists': False}}
+        assert storage1.find_and_modify(query, update)['user_id'] in [0, 2]
+        assert storage2.count(query) == 1
+        m.delete()
+        assert storage1.count({}) == 2
+        models = [SharedModel(user_id=i) for i in range(3, 6)]
+        storage1.bulk_save(models)
+        assert storage2.bulk_update([({'user_id': 3}, {'in_process': 1})]) \
+            == 1
+        storage2.bulk_delete(models[1:])
+        assert storage1.count({}) == 3
+        with pytest.raises(Exception):
+            SharedMemoryStorage({'address': config['address']},
+                                collection='sharedmodel')
+    finally:
+        manager.shutdown()
+
+
+def test_memory_storage_journal(tmpdir):
+    class JournalModel(Model):
+        save_fields = ['user_id', 'created', 'in_process']
+
+    config = {'journal_dir': str(tmpdir), 'snapshot_interval': 4}
+
+    def restart():
+        MemoryStorage._items.pop('journalmodel', None)
+        MemoryStorage._indexes.pop('journalmodel', None)
+        journal = MemoryStorage._journals.pop('journalmodel', None)
+        if journal is not None:
+            journal.close()
+        JournalModel.storage = MemoryStorage(config, collection='journalmodel',
+                                             indexes=['user_id'])
+
+    restart()
+    created = datetime.datetime(2016, 9, 1, 12, 30)
+    for i in range(5):
+        JournalModel.create(user_id=i, created=created)
+    JournalModel.storage.update({'user_id': 3}, {'in_process': True})
+    JournalModel.get({'user_id': 4}).delete()
+    # snapshot was taken after 4th record
+    assert tmpdir.join('journalmodel.snapshot').check()
+    with tmpdir.join('journalmodel.journal').open('a') as f:
+        f.write('{"op": "save", "id"\n{"op": "delete", "id": 1}\n')
+    assert JournalModel.storage.blocking
+    assert oct(tmpdir.join('journalmodel.journal').stat().mode & 0o777) == \
+        oct(0o600)
+    # the journal is locked by the first storage
+    with pytest.raises(Exception):
+        MemoryJournal(str(tmpdir), 'journalmodel')
+
+    restart()
+    assert JournalModel.count() == 4
+    assert JournalModel.count({'user_id': 4}) == 0
+    m = JournalModel.get({'user_id': 3})
+    assert m.in_process is True
+    assert m.created == created
+    assert JournalModel.count({'user_id': 1}) == 1
+    JournalModel.create(user_id=5)
+    restart()
+    assert JournalModel.count() == 5
+    MemoryStorage._journals.pop('journalmodel').close()
+
+
+def test_memory_storage_compiled_query():
+    match = MemoryStorage._get_predicate(
+        {'user_id': 1, 'data.key': {'$in': ['a', 'b']}, 'in_process': {
+            '$exists': False}, 'photo': {'size': {'$gte': 10}}})
+    document = {'user_id': 1.0, 'data': {'key': 'b'}, 'photo': {'size': 10}}
+    assert match(document)
+    assert not match(dict(document, in_process=True))
+    assert not match(dict(document, photo={'size': 9}))
+    assert not match(dict(document, photo=None))
+    assert not match({'user_id': 1, 'data': {'key': 'c'}})
+
+    shapes = len(MemoryStorage._predicates)
+    match = MemoryStorage._get_predicate(
+        {'user_id': 2, 'data.key': {'$in': ['c']}, 'in_process': {
+            '$exists': True}, 'photo': {'size': {'$gte': 0}}})
+    assert len(MemoryStorage._predicates) == shapes
+    assert match({'user_id': 2, 'data': {'key': 'c'}, 'in_process': True,
+                  'photo': {'size': 0}})
+    assert MemoryStorage._get_predicate({})({'user_id': 1})
+
+
+def test_memory_storage_top_k():
+    class QueueModel(Model):
+        save_fields = ['user_id', 'created', 'in_process']
+
+    storage = MemoryStorage({}, collection='queuemodel',
+                            indexes=['in_process', ('created', 1)])
+    QueueModel.storage = storage
+    start = datetime.datetime(2016, 9, 1, 12, 30)
+    for i in range(100):
+        QueueModel.create(user_id=i % 3, created=start - datetime.timedelta(
+            seconds=i))
+
+    query = {'in_process': {'$exists': False}}
+    ids, ordered = storage._plan(query, [('created', 1)], limit=1)
+    assert ordered
+    assert storage.get({'id': next(ids)})['user_id'] == 99 % 3
+    update = {'$set': {'in_process': True}}
+    claimed = storage.find_and_modify(query, update, [('created', 1)])
+    assert claimed['created'] == start - datetime.timedelta(seconds=99)
+    claimed = storage.find_and_modify(query, update, [('created', 1)])
+    assert claimed['created'] == start - datetime.timedelta(seconds=98)
+
+    # heap selection without index on sort keys
+    objects = storage.find({}, [('user_id', -1), ('created', -1)], skip=1,
+                           limit=2)
+    assert [x['user_id'] for x in objects] == [2, 2]
+    assert [x['created'] for x in objects] == \
+        [start - datetime.timedelta(seconds=5),
+         start - datetime.timedelta(seconds=8)]
+    objects = storage.find({'user_id': 0}, [('user_id', 1), ('created', -1)],
+                           limit=1)
+    assert objects[0]['created'] == start
+
+
+def test_memory_storage_compound_index():
+    storage = MemoryStorage({}, collection='compoundmodel', indexes=[
+        Index('in_process', ('created', 1), ttl=60),
+    ])
+    indexes = MemoryStorage._indexes['compoundmodel']
+    assert isinstance(indexes['in_process'], HashIndex)
+    assert isinstance(indexes['created'], SortedIndex)
+    storage.create_index('in_process')
+    assert len(indexes) == 2
+
+
+def test_retention(tmpdir):
+    class RetentionModel(Model):
+        save_fields = ['created']
+
+    now = datetime.datetime.utcnow()
+    indexes = [Index(('created', 1), ttl=3600)]
+
+    def create(storage, hours_list):
+        RetentionModel.storage = storage
+        return [RetentionModel.create(
+                    created=now - datetime.timedelta(hours=hours))
+                for hours in hours_list]
+
+    storage = MemoryStorage({}, collection='retentionmodel', indexes=indexes,
+                            max_documents=3)
+    storage._next_sweep = time.monotonic() + 60
+    create(storage, [5, 0, 2, 0, 0])
+    # the oldest inserted ones were removed
+    assert storage.count({}) == 3
+    assert storage.count({'created': {'$lt': now}}) == 1
+    storage.sweep()
+    assert storage.count({}) == 2
+    storage._next_sweep = 0
+    create(storage, [2])
+    assert storage.count({}) == 2
+
+    # sqlite applies max_documents in sweep only
+    storage = SqliteStorage({'path': str(tmpdir.join('test.sqlite'))},
+                            collection='retentionmodel', indexes=indexes,
+                            max_documents=3)
+    storage._next_sweep = time.monotonic() + 60
+    models = create(storage, [0, 5, 0, 2, 0, 0])
+    # saved again, but still the oldest inserted one
+    storage.save(models[0])
+    assert storage.count({}) == 6
+    storage.sweep()
+    assert storage.count({}) == 3
+    assert storage.count({'id': models[0].id}) == 0
+    assert storage.count({'created': {'$lt': now}}) == 0
+
+
+def test_bulk_operations(tmpdir):
+    class BulkModel(Model):
+        save_fields = ['user_id', 'in_process']
+
+    storages = [
+        MemoryStorage({}, collection='bulkmodel'),
+        SqliteStorage({'path': str(tmpdir.join('test.sqlite'))},
+                      collection='bulkmodel'),
+    ]
+    for storage in storages:
+        BulkModel.storage = storage
+        models = [BulkModel(user_id=i) for i in range(10)]
+        BulkModel.bulk_save(models)
+        assert all(m.id for m in models)
+        assert BulkModel.count() == 10
+        models[0].user_id = 100
+        BulkModel.bulk_save(models[:2])
+        assert BulkModel.count() == 10
+        assert BulkModel.get({'id': models[0].id}).user_id == 100
+
+        updates = [({'id': m.id}, {'in_process': True}) for m in models[:5]]
+        updates.append(({'id': 'unknown'}, {'in_process': True}))
+        assert BulkModel.bulk_update(updates) == 5
+        assert BulkModel.count({'in_process': True}) == 5
+
+        BulkModel.bulk_delete(models[3:])
+        assert BulkModel.count() == 3
+        BulkModel.bulk_delete([])
+        assert BulkModel.count() == 3
+
+
+def test_claim(tmpdir):
+    class ClaimModel(Model):
+        save_fields = ['user_id', 'created', 'in_process']
+
+    now = datetime.datetime.now()
+    storages = [
+        MemoryStorage({}, collection='claimmodel'),
+        SqliteStorage({'path': str(tmpdir.join('test.sqlite'))},
+                      collection='claimmodel'),
+    ]
+    query = {'in_process': {'$exists': False}}
+    sort = [('created', 1)]
+    for storage in storages:
+        ClaimModel.storage = storage
+        for i in range(5):
+            ClaimModel.create(user_id=i,
+                              created=now - datetime.timedelta(seconds=i))
+        claimed = ClaimModel.claim(query, {'in_process': True}, sort, 3,
+                                   increment={'attempts': 1})
+        assert [m.user_id for m in claimed] == [4, 3, 2]
+        assert all(m.in_process for m in claimed)
+        assert all(m.attempts == 1 for m in claimed)
+        assert len({m.claim_id for m in claimed}) == 1
+        assert ClaimModel.count({'claim_id': claimed[0].claim_id}) == 3
+
+        claimed = ClaimModel.claim(query, {'in_process': True}, sort, 3)
+        assert [m.user_id for m in claimed] == [1, 0]
+        assert ClaimModel.claim(query, {'in_process': True}, sort, 3) == []
+
+
+def test_storage_stats(tmpdir, caplog):
+    class StatsModel(Model):
+        save_fields = ['value']
+
+    storage_stats.reset()
+    config = {'path': str(tmpdir.join('test.sqlite')), 'slow_query_ms': 0}
+    StatsModel.storage = SqliteStorage(config, collection='statsmodel')
+    caplog.set_level(logging.WARNING, logger='storage')
+    for i in range(3):
+        StatsModel.create(value=i)
+    assert len(list(StatsModel.find({'value': {'$gte': 1}}, lazy=True))) == 2
+    with pytest.raises(Exception):
+        StatsModel.count({'bad key': 1})
+
+    stats = {x['operation']: x for x in storage_stats.get()}
+    assert set(stats) == {'save', 'find', 'count'}
+    assert stats['save']['count'] == 3
+    assert stats['count']['errors'] == 1
+    assert stats['find']['collection'] == 'statsmodel'
+    assert "Slow find on statsmodel" in caplog.text
+    assert "query {'value': {'$gte': '?'}}" in caplog.text
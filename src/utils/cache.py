@@ -0,0 +1,193 @@
+import asyncio
+import collections
+import copy
+import logging
+import os
+import pickle
+import time
+
+import aiomcache
+
+
+class LruCache:
+    '''
+    In-process cache with LRU eviction and TTL (in seconds)
+    '''
+
+    def __init__(self, max_size=1000, ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return
+        expire_time, value = item
+        if expire_time < time.monotonic():
+            del self._items[key]
+            return
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def delete(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+
+class MemcachedCache:
+    '''
+    Cache shared by processes. Values are pickled. Memcached errors are
+    logged and treated as cache misses
+    '''
+
+    def __init__(self, host='127.0.0.1', port=11211, ttl=300, *, prefix='',
+                 logger=None):
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.prefix = prefix
+        self.logger = logger or logging.getLogger()
+        self._client = None
+        self._pid = None
+
+    def _get_client(self):
+        # connections of the client don't survive fork()
+        if self._client is None or self._pid != os.getpid():
+            self._client = aiomcache.Client(self.host, self.port)
+            self._pid = os.getpid()
+        return self._client
+
+    def _get_key(self, key):
+        return '{0}{1}'.format(self.prefix, key).encode()
+
+    async def get(self, key):
+        try:
+            data = await self._get_client().get(self._get_key(key))
+        except Exception as e:
+            self.logger.warning('Memcached get failed: {0}'.format(e))
+            return
+        if data is not None:
+            return pickle.loads(data)
+
+    async def set(self, key, value):
+        try:
+            await self._get_client().set(self._get_key(key),
+                                         pickle.dumps(value),
+                                         exptime=self.ttl)
+        except Exception as e:
+            self.logger.warning('Memcached set failed: {0}'.format(e))
+
+    async def add(self, key, value):
+        '''
+        Stores value only if key is not cached yet
+        '''
+        try:
+            await self._get_client().add(self._get_key(key),
+                                         pickle.dumps(value),
+                                         exptime=self.ttl)
+        except Exception as e:
+            self.logger.warning('Memcached add failed: {0}'.format(e))
+
+    async def delete(self, key):
+        try:
+            await self._get_client().delete(self._get_key(key))
+        except Exception as e:
+            self.logger.warning('Memcached delete failed: {0}'.format(e))
+
+
+class DocumentCache:
+    '''
+    Two-tier read-through cache for storage documents: in-process LruCache
+    in front of optional MemcachedCache shared by web and dealer processes.
+    Documents are copied, so changes of returned documents don't affect
+    the cache. Other processes don't invalidate the local tier, so it can
+    be disabled (local=None) for documents changed by several processes.
+    '''
+
+    def __init__(self, name, local: LruCache=None,
+                 shared: MemcachedCache=None):
+        self.name = name
+        self.local = local
+        self.shared = shared
+
+    @property
+    def enabled(self):
+        return self.local is not None or self.shared is not None
+
+    @classmethod
+    def from_config(cls, name, config: dict, *, prefix='', local=True):
+        if local:
+            local = LruCache(config.get('local_size', 1000),
+                             config.get('local_ttl', 5))
+        else:
+            local = None
+        shared = None
+        if config.get('memcached_host'):
+            shared = MemcachedCache(
+                config['memcached_host'],
+                config.get('memcached_port', 11211),
+                config.get('memcached_ttl', 300),
+                prefix='{0}{1}:'.format(prefix, name)
+            )
+        return cls(name, local, shared)
+
+    async def get(self, key):
+        value = None
+        if self.local is not None:
+            value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = await self.shared.get(key)
+            if value is not None and self.local is not None:
+                self.local.set(key, value)
+        if value is not None:
+            return copy.deepcopy(value)
+
+    async def set(self, key, value):
+        value = copy.deepcopy(value)
+        if self.local is not None:
+            self.local.set(key, value)
+        if self.shared is not None:
+            await self.shared.set(key, value)
+
+    async def add(self, key, value):
+        '''
+        set() for read-through fills: value loaded from storage doesn't
+        overwrite the document cached by another process meanwhile
+        '''
+        value = copy.deepcopy(value)
+        if self.local is not None and self.local.get(key) is None:
+            self.local.set(key, value)
+        if self.shared is not None:
+            await self.shared.add(key, value)
+
+    async def delete(self, key):
+        if self.local is not None:
+            self.local.delete(key)
+        if self.shared is not None:
+            await self.shared.delete(key)
+
+    def invalidate(self, key):
+        '''
+        delete() for synchronous code
+        '''
+        if self.local is not None:
+            self.local.delete(key)
+        if self.shared is None:
+            return
+        loop = asyncio.get_event_loop()
+        if loop.is_running():
+            asyncio.ensure_future(self.shared.delete(key))
+        else:
+            loop.run_until_complete(self.shared.delete(key))
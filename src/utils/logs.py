@@ -101,6 +101,7 @@ def get_config(project_name, logs_dir, smtp_settings):
             'telegram_api_file': file_handler('telegram.log'),
             'dealer_file': file_handler('dealer.log', log_level or 'INFO'),
             'downloader_file': file_handler('downloader.log'),
+            'storage_file': file_handler('storage.log', 'WARNING'),
             'email': file_handler('email.log', 'ERROR'),
         },
 
@@ -118,6 +119,8 @@ def get_config(project_name, logs_dir, smtp_settings):
             'dealer': logger(log_level or 'ERROR', ['dealer_file', 'email']),
             'downloader': logger(log_level or 'ERROR',
                                  ['downloader_file', 'email']),
+            'storage': logger(log_level or 'WARNING',
+                              ['storage_file', 'email']),
             # bot
             'bot': logger(log_level or 'WARNING', ['file', 'email']),
             '': logger(log_level or 'ERROR', ['file', 'email'], True),
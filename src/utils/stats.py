@@ -0,0 +1,42 @@
+import bisect
+
+
+class LatencyHistogram:
+    '''
+    Histogram of durations (in seconds) with fixed exponential buckets.
+    Percentiles are approximated by upper bounds of buckets
+    '''
+
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration: float):
+        self.counts[bisect.bisect_left(self.buckets, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, p: float):
+        if not self.count:
+            return 0.0
+        threshold = p * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                if i < len(self.buckets):
+                    return min(self.buckets[i], self.max)
+                break
+        return self.max
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
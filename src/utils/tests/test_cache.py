@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+from utils.cache import DocumentCache
+from utils.cache import LruCache
+
+
+def test_lru_cache(monkeypatch):
+    cache = LruCache(max_size=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    cache.delete('c')
+    assert cache.get('c') is None
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 11)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_document_cache():
+    cache = DocumentCache.from_config('user', {'local_ttl': 10})
+    assert cache.shared is None
+    loop = asyncio.get_event_loop()
+    document = {'id': 1, 'places': {'a': 'b'}}
+    loop.run_until_complete(cache.set(1, document))
+    document['places']['a'] = 'c'
+    cached = loop.run_until_complete(cache.get(1))
+    assert cached == {'id': 1, 'places': {'a': 'b'}}
+    cached['places']['a'] = 'd'
+    assert loop.run_until_complete(cache.get(1))['places']['a'] == 'b'
+    # read-through fill keeps cached document
+    loop.run_until_complete(cache.add(1, {'id': 1, 'places': {}}))
+    assert loop.run_until_complete(cache.get(1))['places'] == {'a': 'b'}
+    cache.invalidate(1)
+    assert loop.run_until_complete(cache.get(1)) is None
+    loop.run_until_complete(cache.add(1, {'id': 1, 'places': {}}))
+    assert loop.run_until_complete(cache.get(1))['places'] == {}
+
+    cache = DocumentCache.from_config('user', {}, local=False)
+    assert not cache.enabled
+    loop.run_until_complete(cache.set(1, document))
+    assert loop.run_until_complete(cache.get(1)) is None
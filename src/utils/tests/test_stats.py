@@ -0,0 +1,17 @@
+from utils.stats import LatencyHistogram
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(0.5) == 0
+    for i in range(90):
+        histogram.add(0.0007)
+    for i in range(10):
+        histogram.add(0.3)
+    assert histogram.count == 100
+    assert histogram.percentile(0.5) == 0.001
+    assert histogram.percentile(0.95) == 0.3
+    assert histogram.max == 0.3
+    assert abs(histogram.mean - 0.03063) < 1e-9
+    histogram.add(20)
+    assert histogram.percentile(1) == 20
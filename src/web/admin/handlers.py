@@ -1,6 +1,7 @@
 import time
 import datetime
 import hashlib
+import json
 from bson import ObjectId
 import aiohttp_jinja2
 from aiohttp import web
@@ -9,6 +10,7 @@ from bot.model import FailedUpdate
 from bot.model import TelegramUpdate
 from bot.model import User
 from bot.model import TelegramUpdateLog
+from bot.storage import storage_stats
 from config import config
 from web import cookies
 
@@ -77,7 +79,7 @@ async def logout(request):
 
 
 async def dashboard(request):
-    params = {'cnt_failed_updates': len(FailedUpdate.find())}
+    params = {'cnt_failed_updates': FailedUpdate.count()}
     return aiohttp_jinja2.render_template('dashboard.html', request, params)
 
 
@@ -90,7 +92,9 @@ async def list_downloads(request):
 
 
 async def list_failed_updates(request):
-    failed_updates = [update.save_data() for update in FailedUpdate.find()]
+    failed_updates = (
+        update.save_data() for update in FailedUpdate.find(lazy=True)
+    )
     params = {'failed_updates': failed_updates}
     response = aiohttp_jinja2.render_template('failed_updates.html', request,
                                               params)
@@ -98,7 +102,9 @@ async def list_failed_updates(request):
 
 
 async def list_updates(request):
-    updates = [update.save_data() for update in TelegramUpdate.find()]
+    updates = (
+        update.save_data() for update in TelegramUpdate.find(lazy=True)
+    )
     params = {'queue': updates}
     response = aiohttp_jinja2.render_template('queue.html', request, params)
     return response
@@ -108,20 +114,33 @@ async def fix_failed_update(request):
     await request.post()
     update_id = request.POST.get('update_id')
     if update_id:
-        updates = [FailedUpdate.get({'id': ObjectId(update_id)})]
+        ids = [ObjectId(update_id)]
     elif not update_id and request.POST.get('all'):
-        updates = FailedUpdate.find()
+        # replays which fail again create new failed updates, they must not
+        # be replayed in this request
+        ids = [x.id for x in FailedUpdate.find(fields=['id'])]
     else:
-        updates = []
-    for failed_update in updates:
-        await request.app.bot.handle_update({
-            'update_id': failed_update.id,
-            'message': failed_update.message
-        })
-        failed_update.delete()
+        ids = []
+    for i in range(0, len(ids), 100):
+        updates = FailedUpdate.find({'id': {'$in': ids[i:i + 100]}})
+        for failed_update in updates:
+            await request.app.bot.handle_update({
+                'update_id': failed_update.id,
+                'message': failed_update.message
+            })
+        FailedUpdate.bulk_delete(updates)
     return await list_failed_updates(request)
 
 
+async def view_storage_stats(request):
+    stats = storage_stats.get()
+    if request.GET.get('format') == 'json':
+        return web.Response(text=json.dumps(stats),
+                            content_type='application/json')
+    return aiohttp_jinja2.render_template('storage_stats.html', request,
+                                          {'stats': stats})
+
+
 async def list_users(request):
     page = request.GET.get('page', 0)
     page_size = 50
@@ -132,9 +151,11 @@ async def list_users(request):
     weekly_active = User.count({'last_request_time': {'$gte': week_ago}})
     monthly_active = User.count({'last_request_time': {'$gte': month_ago}})
     num_pages = total_cnt / page_size + 1
-    all_users = User.find({}, skip=page*page_size, limit=page_size,
-                          sort=[('last_request_time', -1)])
-    users = [x for x in all_users]
+    fields = ['name', 'username', 'created', 'last_request_time', 'state',
+              'mode']
+    users = User.find({}, skip=page*page_size, limit=page_size,
+                      sort=[('last_request_time', -1)], lazy=True,
+                      batch_size=page_size, fields=fields)
     return aiohttp_jinja2.render_template(
         'users.html',
         request,
@@ -166,7 +187,8 @@ async def view_telegram_update_logs(request):
     num_pages = total_cnt / page_size + 1
     logs = []
     updates = TelegramUpdateLog.find({}, skip=page*page_size, limit=page_size,
-                                     sort=[('created', -1)])
+                                     sort=[('created', -1)], lazy=True,
+                                     batch_size=page_size)
     for entry in updates:
         update = entry.update
         if not update.get('message') and update.get('edited_message'):
@@ -6,6 +6,7 @@ from web.admin.handlers import list_failed_updates
 from web.admin.handlers import list_updates
 from web.admin.handlers import list_users
 from web.admin.handlers import view_telegram_update_logs
+from web.admin.handlers import view_storage_stats
 from web.admin.handlers import fix_failed_update
 from web.admin.handlers import admin_url
 
@@ -23,6 +24,7 @@ auth_required_urls = [
     ('GET', admin_url('/queue'), list_updates),
     ('GET', admin_url('/users'), list_users),
     ('GET', admin_url('/logs'), view_telegram_update_logs),
+    ('GET', admin_url('/storage'), view_storage_stats),
     ('POST', admin_url('/fix_failed_update'), fix_failed_update),
 ]
 
@@ -17,7 +17,9 @@ async def oauth_callback(request):
     callback_key = params.get('key', [''])[0]
     session_key = params.get('session_key')[0]
     try:
-        session = StartSession.get({'oauth_data.callback_key': callback_key})
+        session = await StartSession.aget(
+            {'oauth_data.callback_key': callback_key}
+        )
     except ModelNotFound as e:
         logger.error(e, exc_info=1)
         return web.HTTPForbidden()
@@ -62,7 +64,7 @@ connection. Please try again later'
     text = 'Evernote account is connected.\n\
 From now you can just send message and note be created.'
     bot.send_message(user.telegram_chat_id, text)
-    user.save()
+    await user.asave()
     return web.HTTPFound(bot.url)
 
 
@@ -96,8 +98,10 @@ async def oauth_callback_full_access(request):
     callback_key = params.get('key', [''])[0]
     session_key = params.get('session_key')[0]
     try:
-        session = StartSession.get({'oauth_data.callback_key': callback_key})
-        user = User.get({'id': session.id})
+        session = await StartSession.aget(
+            {'oauth_data.callback_key': callback_key}
+        )
+        user = await User.aget({'id': session.id})
     except ModelNotFound as e:
         logger.error(e, exc_info=1)
         return web.HTTPForbidden()
@@ -58,3 +58,9 @@ app.logger = get_logger('bot')
 bot = EvernoteBot(config['telegram']['token'], 'evernoterobot')
 bot.config = config  # FIXME:
 app.bot = bot
+
+
+async def flush_user_activity(app):
+    await app.bot.activity.flush()
+
+app.on_shutdown.append(flush_user_activity)